@@ -15,12 +15,14 @@ settings.GAUGES_PATH = settings.DEFAULT_PATH.joinpath("gauges")  # Path to the c
 settings.XML_FILES_PATH = settings.DEFAULT_PATH.joinpath("xml_files")  # Path to the xml_files directory
 settings.MODELS_PATH = settings.DEFAULT_PATH.joinpath("models")  # Path to the models' directory
 settings.FRAMES_PATH = settings.DEFAULT_PATH.joinpath("frames")  # Path to the frames directory
+settings.DATASETS_PATH = settings.DEFAULT_PATH.joinpath("datasets")  # Path to the generated datasets cache
 settings.DEV_CALIBRATION_FILE_XML = settings.GAUGES_PATH.joinpath(settings.GAUGE_CALIBRATION_FILE_XML)
 settings.dir_list = [settings.DEFAULT_PATH,  # List of directories to create
                      settings.GAUGES_PATH,
                      settings.MODELS_PATH,
                      settings.XML_FILES_PATH,
-                     settings.FRAMES_PATH]
+                     settings.FRAMES_PATH,
+                     settings.DATASETS_PATH]
 
 # Torch parameters
 settings.DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -0,0 +1,32 @@
+import os
+import sys
+import cv2
+from pathlib import Path
+
+FILE = Path(__file__).parent.parent.resolve()
+if FILE not in sys.path:
+    sys.path.append(str(FILE))
+
+import src.gauges.gauge as g
+import src.model.backends as backends
+import src.utils.benchmark as bm
+
+from config import settings
+
+analog_gauge = g.AnalogGauge('camera_1_analog_gauge_1.xml')
+plan = analog_gauge.get_read_plan()
+frames = [cv2.imread(os.path.join(settings.FRAMES_PATH, name), cv2.IMREAD_GRAYSCALE)
+          for name in sorted(os.listdir(settings.FRAMES_PATH))]
+frames = [frame for frame in frames if frame is not None]
+
+bm.print_report('Preprocessing parity', bm.preprocess_parity(plan, frames))
+bm.print_report('Preprocessing latency', bm.preprocess_benchmark(plan, frames[0]))
+bm.print_report('Reduced resolution decode', bm.decode_benchmark(plan, sorted(os.listdir(settings.FRAMES_PATH))[0]))
+
+analog_gauge.initialize()
+models = {'torch': analog_gauge.init_backend(backends.TorchBackend.name),
+          'onnx': analog_gauge.init_backend(backends.OnnxBackend.name),
+          'int8': analog_gauge.init_backend(backends.QuantizedBackend.name)}
+bm.print_report('Inference latency', bm.backend_benchmark(models))
+bm.print_report('Polar needle estimator', bm.polar_benchmark(analog_gauge))
+bm.print_report('Reading engine throughput', bm.engine_benchmark(analog_gauge, frames[0]))
@@ -0,0 +1,12 @@
+import sys
+from pathlib import Path
+
+FILE = Path(__file__).parent.parent.resolve()
+if FILE not in sys.path:
+    sys.path.append(str(FILE))
+
+import src.utils.benchmark as bm
+
+report = bm.import_benchmark()
+bm.print_report('Reading path import time', report)
+sys.exit(0 if report['within_budget'] else 1)
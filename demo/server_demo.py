@@ -0,0 +1,21 @@
+import os
+import sys
+import threading
+from pathlib import Path
+
+FILE = Path(__file__).parent.parent.resolve()
+if FILE not in sys.path:
+    sys.path.append(str(FILE))
+
+import src.server.reading_server as rs
+import src.utils.benchmark as bm
+
+from config import settings
+
+gauge = 'camera_1_analog_gauge_1.xml'
+frame = sorted(os.listdir(settings.FRAMES_PATH))[0]
+
+# Serve in the background and load test the server with concurrent clients
+threading.Thread(target=rs.serve, kwargs={'gauges': [gauge]}, daemon=True).start()
+bm.wait_for_port(settings.SERVER_HOST, settings.SERVER_PORT)
+bm.print_report('Reading server', bm.server_benchmark({'gauge': gauge, 'frame': frame}))
@@ -0,0 +1,162 @@
+import os
+import glob
+import torch
+import typer
+
+import numpy as np
+
+import src.gauges.gauge as g
+import src.utils.image_editing as ie
+import src.utils.ingest_queue as iq
+import src.utils.read_plan as rp
+
+from config import settings
+
+
+def predict_rows(gauges: list,
+                 images: torch.Tensor,
+                 rows: list,
+                 polar_mode: str) -> dict:
+    """
+    Predict the needle angles of a batch of gauges' images. Each gauge has its own weights, gauges sharing a model
+    are batched together and every distinct model runs a single forward pass. The polar estimators are per gauge,
+    unless the polar mode is off each gauge predicts its own image.
+    :param gauges: list of AnalogGauge objects, one per image
+    :param images: stacked images of the gauges
+    :param rows: rows of the gauges (and images) to predict
+    :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
+    :return: dict of row to predicted angle (radians)
+    """
+    groups = {}
+    models = {}
+    for row in rows:
+        if polar_mode == 'off':
+            model = gauges[row].inference_model
+            models[id(model)] = model
+            groups.setdefault(id(model), []).append(row)
+        else:
+            models[row] = None
+            groups[row] = [row]
+    rad = {}
+    for key, group in groups.items():
+        values = gauges[group[0]].predict(images[group], model=models[key], polar_mode=polar_mode).reshape(-1)
+        rad.update(zip(group, values.tolist()))
+    return rad
+
+
+class CameraReader:
+    def __init__(self,
+                 camera_id: int,
+                 gauges: list = None,
+                 queue_size: int = settings.INGEST_QUEUE_SIZE,
+                 policy: str = settings.INGEST_POLICY):
+        """
+        Read all the calibrated gauges of a camera from a single decoded frame. Frames are submitted to a bounded
+        ingest queue, so a burst of frames is dropped or coalesced by the policy instead of backing up the readings.
+        :param camera_id: Camera ID of the gauges
+        :param gauges: optional, list of AnalogGauge objects. If not specified, all the camera's XML files are loaded
+        :param queue_size: max number of queued frames
+        :param policy: ingest queue policy, one of 'drop_oldest', 'drop_newest', 'coalesce'
+        """
+        self.camera_id = int(camera_id)
+        self.gauges = gauges if gauges is not None else self.load_gauges(self.camera_id)
+        self.ingest = iq.IngestQueue(maxsize=queue_size, policy=policy)
+        # Full resolution shape of the last frame and reduction factor of its decode
+        self.frame_shape = None
+        self.decode_factor = 1
+
+    @staticmethod
+    def load_gauges(camera_id: int) -> list:
+        """
+        Load all the analog gauges calibrated for a camera from the XML files directory
+        :param camera_id: Camera ID of the gauges
+        :return: list of AnalogGauge objects
+        """
+        pattern = os.path.join(settings.XML_FILES_PATH, settings.XML_FILE_NAME.format(camera_id, '*') + '.xml')
+        return [g.AnalogGauge(os.path.basename(path)) for path in sorted(glob.glob(pattern))]
+
+    def initialize(self,
+                   force_train: bool = False):
+        """
+        Initialize (load or train the models of) all the gauges of the camera
+        :param force_train: Train even if a model is found
+        :return: None
+        """
+        for gauge in self.gauges:
+            gauge.initialize(force_train=force_train)
+
+    def get_readings(self,
+                     frame: str or bytes or ie.RawFrame or np.ndarray,
+                     prints: bool = True,
+                     gate: bool = settings.CHANGE_GATING == 'True',
+                     polar_mode: str = settings.POLAR_MODE) -> dict:
+        """
+        Get the readings of all the gauges of the camera. The frame is decoded once, the gauges' images are
+        stacked into one batch and every distinct model runs a single forward pass over its gauges' images.
+        Frame files and encoded frames are decoded at the largest reduced resolution every gauge's crop allows.
+        :param frame: file name in the frames directory, encoded image, RawFrame or image
+        :param prints: Print the results
+        :param gate: Reuse the last reading of the gauges whose ROI did not change, only the others are inferred
+        :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
+        :return: dict of gauge index to reading
+        """
+        if not self.gauges:
+            return {}
+        frame, factor, shape = rp.decode_frame(frame, [gauge.get_read_plan() for gauge in self.gauges], self.frame_shape)
+        self.frame_shape = tuple(shape)
+        if factor != self.decode_factor:
+            self.decode_factor = factor
+            typer.secho(f'Camera {self.camera_id}: frames decoded at 1/{factor} resolution', fg='blue')
+        images = torch.cat([gauge.frame_to_image(frame, factor=factor, shape=shape) for gauge in self.gauges])
+        readings = {}
+        signatures = {}
+        rows = []
+        for row, gauge in enumerate(self.gauges):
+            if gate:
+                signatures[row], reading = gauge.change_gate.lookup(images[row:row + 1], polar_mode)
+                if reading is not None:
+                    readings[gauge.calibration['index']] = reading
+                    continue
+            rows.append(row)
+        for row, value in predict_rows(self.gauges, images, rows, polar_mode).items():
+            gauge = self.gauges[row]
+            readings[gauge.calibration['index']] = float(gauge.get_values(rad=[value])[0])
+            if gate:
+                gauge.change_gate.store(signatures[row], readings[gauge.calibration['index']], polar_mode)
+        if prints:
+            for gauge in self.gauges:
+                gauge.print_reading(readings[gauge.calibration['index']])
+        return readings
+
+    def submit(self,
+               frame: str or bytes or ie.RawFrame or np.ndarray) -> bool:
+        """
+        Queue a frame for reading, never blocks
+        :param frame: file name in the frames directory, encoded image, RawFrame or image
+        :return: True if the frame was queued, False if the policy dropped it
+        """
+        return self.ingest.put(frame)[0]
+
+    def process(self,
+                timeout: float = None,
+                prints: bool = False) -> dict or None:
+        """
+        Read the gauges from the next queued frame
+        :param timeout: optional, max wait (s) for a frame. If not specified, waits until a frame is queued
+        :param prints: Print the results
+        :return: dict of gauge index to reading, or None on timeout
+        """
+        frame = self.ingest.get(timeout=timeout)
+        if frame is None:
+            return None
+        return self.get_readings(frame, prints=prints)
+
+    def stats(self) -> dict:
+        """
+        Ingest queue and change gate counters of the camera
+        :return: dict of the ingest queue counters, and the inferred and skipped readings of the gauges
+        """
+        stats = self.ingest.stats()
+        stats['inferred'] = sum(gauge.change_gate.inferred for gauge in self.gauges)
+        stats['skipped'] = sum(gauge.change_gate.skipped for gauge in self.gauges)
+        return stats
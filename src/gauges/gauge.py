@@ -4,18 +4,23 @@ import typer
 import torch
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 from datetime import datetime
-from pathlib import Path
 from torch.utils.data import DataLoader
 
 import src.model.dataset_class as img_dataset
+import src.model.dataset_generation as dg
+import src.model.dataset_cache as dcache
 import src.model.gauge_net as gn
-import src.calibrator.app as calibrator
+import src.model.backends as backends
+import src.model.quantization as quantization
+import src.model.model_cache as mc
+import src.model.polar_estimator as pe
 import src.utils.convert_xml as xmlr
 import src.utils.image_editing as ie
 import src.utils.envconfig as env
+import src.utils.read_plan as rp
+import src.utils.change_gate as cg
 
 from config import settings
 
@@ -28,6 +33,7 @@ class Gauge:
         Initialize the gauge.
         :param calibration: Calibration dictionary or path to the calibration xml file.
         """
+        self._read_plans = {}
         if isinstance(calibration, dict):
             self.calibration = calibration
         elif isinstance(calibration, str):
@@ -41,6 +47,35 @@ class Gauge:
             self.calibration['directory'] = self.directory
         self.transfer_learning = transfer_learning
 
+    @property
+    def calibration(self) -> dict:
+        return self._calibration
+
+    @calibration.setter
+    def calibration(self, calibration: dict):
+        self._calibration = calibration
+        self.refresh_read_plan()
+
+    def get_read_plan(self,
+                      restore_edit_steps: bool = True) -> rp.ReadPlan:
+        """
+        Get the compiled read plan of the gauge, built once and rebuilt only when the calibration changes.
+        :param restore_edit_steps: Perform the edit steps as saved in the XML file
+        :return: ReadPlan
+        """
+        plan = self._read_plans.get(restore_edit_steps)
+        if plan is None:
+            plan = rp.ReadPlan.from_calibration(self.calibration, restore_edit_steps=restore_edit_steps)
+            self._read_plans[restore_edit_steps] = plan
+        return plan
+
+    def refresh_read_plan(self):
+        """
+        Drop the compiled read plans, call after editing the calibration dictionary in place.
+        :return: None
+        """
+        self._read_plans = {}
+
     def initialize(self):
         """
         Start the gauge application.
@@ -91,39 +126,125 @@ class Gauge:
 
 class AnalogGauge(Gauge):
     def __init__(self,
-                 calibration: dict or str = None):
+                 calibration: dict or str = None,
+                 backend: str = settings.INFERENCE_BACKEND):
+        """
+        Initialize the analog gauge.
+        :param calibration: Calibration dictionary or path to the calibration xml file.
+        :param backend: Inference backend of the gauge's readings ('torch', 'onnx', 'int8')
+        """
+        # Last inferred ROI and reading, skips the model while the ROI does not change. Set before the calibration,
+        # which resets it
+        self.change_gate = cg.ChangeGate()
+        # Classical needle estimator, built on first use
+        self._polar_estimator = None
         super().__init__(calibration=calibration)
         # Train/test set directories
         self.train_image_path = os.path.join(self.directory, settings.TRAIN_IMAGE_NAME)
         self.needle_image_path = os.path.join(self.directory, settings.NEEDLE_IMAGE_NAME)
 
-        # Train/test base images
-        self.base_image = cv2.imread(self.train_image_path)
-        if self.base_image is None:
-            raise FileNotFoundError(f'Train image "{self.base_image}" not found')
-        self.needle_image = cv2.imread(self.needle_image_path)
-        if self.needle_image is None:
-            raise FileNotFoundError(f'Needle image "{self.needle_image}" not found')
+        # Train/test base images, only loaded for training
+        self._base_image = None
+        self._needle_image = None
 
         self.angles = None
         self.datasets = None
         self.data_loaders = None
         self.model = None
+        self.backend_name = backend
 
-    def initialize(self,
-                   force_train: bool = False):
-        # Angles
-        self.angles = self.init_angles()
+        # Full resolution shape of the last frame and reduction factor of its decode
+        self.frame_shape = None
+        self.decode_factor = 1
+        self.polar_counts = {'polar': 0, 'model': 0, 'disagreements': 0}
 
-        # Data sets and data loaders
-        self.datasets = self.init_datasets()
+    def refresh_read_plan(self):
+        """
+        Drop the compiled read plans, the last inferred reading and the polar needle estimator, call after editing
+        the calibration dictionary in place.
+        :return: None
+        """
+        super().refresh_read_plan()
+        self.change_gate.reset()
+        self._polar_estimator = None
 
-        # data_loaders
-        self.data_loaders = dict().fromkeys(['train', 'val', 'test'])
+    @property
+    def base_image(self) -> np.ndarray:
+        """
+        Base image (without the needle) of the synthetic datasets, read on first use
+        """
+        if self._base_image is None:
+            self._base_image = cv2.imread(self.train_image_path)
+            if self._base_image is None:
+                raise FileNotFoundError(f'Train image "{self.train_image_path}" not found')
+        return self._base_image
+
+    @property
+    def needle_image(self) -> np.ndarray:
+        """
+        Needle image of the synthetic datasets, read on first use
+        """
+        if self._needle_image is None:
+            self._needle_image = cv2.imread(self.needle_image_path)
+            if self._needle_image is None:
+                raise FileNotFoundError(f'Needle image "{self.needle_image_path}" not found')
+        return self._needle_image
+
+    @property
+    def polar_estimator(self) -> pe.PolarEstimator:
+        """
+        Polar transform needle estimator of the gauge, built on first use from the train and needle images
+        """
+        if self._polar_estimator is None:
+            self._polar_estimator = pe.PolarEstimator(base_image=self.base_image,
+                                                      needle_image=self.needle_image,
+                                                      center=tuple(float(x) for x in self.calibration['center']),
+                                                      radius=float(self.calibration['radius']),
+                                                      min_angle=float(self.calibration['needle']['min_angle']),
+                                                      max_angle=float(self.calibration['needle']['max_angle']))
+        return self._polar_estimator
+
+    @property
+    def model_key(self) -> tuple:
+        """
+        Key of the gauge's inference model in the process-wide model cache
+        """
+        return self.directory, settings.MODEL_VERSION, settings.DEFAULT_MODEL_TYPE, self.backend_name
+
+    @property
+    def inference_model(self):
+        """
+        The inference backend used for readings, loaded through the process-wide model cache (gauges do not
+        hold a reference to it, so evicted models are freed)
+        """
+        return mc.MODEL_CACHE.get(self.model_key, self.load_backend)
+
+    def load_backend(self,
+                     name: str = None) -> backends.InferenceBackend:
+        """
+        Load an inference backend of the gauge from its default model checkpoint
+        :param name: optional, backend name, one of 'torch', 'onnx', 'int8'. If not specified, the gauge's backend
+        :return: InferenceBackend
+        """
+        name = name if name else self.backend_name
+        if name == backends.TorchBackend.name:
+            return backends.TorchBackend(gn.GaugeNet.load(directory=self.directory).eval())
+        return backends.load_backend(name, directory=self.directory)
+
+    def initialize(self,
+                   force_train: bool = False):
+        """
+        Load the gauge's model for readings, or train it if it is missing (or force_train). Only the read plan and
+        the model are loaded for readings, the images, datasets and data loaders are built only for training.
+        :param force_train: Train even if a model is found
+        :return: None
+        """
+        # Read plan
+        self.get_read_plan()
 
         # Model
         try:
-            self.model = gn.GaugeNet.load(directory=self.directory)
+            self.init_backend()
             typer.secho(f'Model loaded from {self.directory}', fg='green')
             train = False or force_train
 
@@ -137,37 +258,132 @@ class AnalogGauge(Gauge):
                 abort=True)
 
         if train:
+            self.init_training_data()
             self.model = gn.GaugeNet(directory=self.directory)
             self.train(transfer_learning=False)
+            self.init_backend()
+
+    def init_training_data(self,
+                           sets: list = ('train', 'val', 'test')):
+        """
+        Build the angles, datasets and data loaders dictionary of the given sets, if not built yet
+        :param sets: set types
+        :return: None
+        """
+        if self.angles is None:
+            self.angles = self.init_angles()
+        if self.datasets is None:
+            self.datasets = {}
+        missing = [set_type for set_type in sets if set_type not in self.datasets]
+        if missing:
+            self.datasets.update(self.init_datasets(sets=missing))
+        if self.data_loaders is None:
+            self.data_loaders = dict().fromkeys(['train', 'val', 'test'])
+
+    def init_backend(self,
+                     name: str = None):
+        """
+        Prepare an inference backend of the gauge and load it through the model cache. The ONNX and int8 models are
+        (re-)built from the default model checkpoint when they are missing or older than the checkpoint. The gauge
+        keeps reading with its own backend, set backend_name to switch it.
+        :param name: optional, backend name, one of 'torch', 'onnx', 'int8'. If not specified, the gauge's backend
+        :return: InferenceBackend
+        """
+        name = name if name else self.backend_name
+        checkpoint = gn.checkpoint_path(self.directory)
+        if name == backends.OnnxBackend.name:
+            path = backends.onnx_path(self.directory)
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(checkpoint):
+                gn.GaugeNet.load(directory=self.directory).export_onnx()
+                typer.secho(f'Model exported to {path}', fg='green')
+        elif name == backends.QuantizedBackend.name:
+            path = quantization.quantized_path(self.directory)
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(checkpoint):
+                self.quantize()
+        key = self.model_key[:-1] + (name,)
+        return mc.MODEL_CACHE.get(key, lambda: self.load_backend(name))
+
+    def quantize(self) -> dict:
+        """
+        Quantize the default model checkpoint to int8, calibrated on the validation set, and save it next to the
+        checkpoint. The accuracy loss is reported on the test set, in gauge units.
+        :return: dict of the accuracy report
+        """
+        self.init_training_data(sets=['val', 'test'])
+        self.init_data_loaders(sets=['val', 'test'])
+        model = gn.GaugeNet.load(directory=self.directory)
+        quantized = quantization.quantize(model, self.data_loaders['val'])
+        path = quantization.save(quantized, self.directory)
+        report = quantization.accuracy_loss(model, quantized, self.data_loaders['test'], self.get_read_plan())
+        units = self.calibration['units']
+        typer.secho(f'Quantized model saved to {path} | '
+                    f'Test MAE: fp32 {report["fp32_mae"]:.4f} {units}, int8 {report["int8_mae"]:.4f} {units} | '
+                    f'int8 vs fp32: mean {report["mean_diff"]:.4f} {units}, max {report["max_diff"]:.4f} {units}',
+                    fg='green')
+        return report
 
     def init_angles(self):
         min_angle = float(self.calibration['needle']['min_angle'])
         max_angle = float(self.calibration['needle']['max_angle'])
+        # Seeded, so the same calibration always gives the same sets (and cached datasets stay valid)
+        rng = np.random.RandomState(settings.DATASET_SEED)
         train_angles = np.linspace(min_angle, max_angle, settings.IMAGE_TRAIN_SET_SIZE)
-        val_angles = np.random.uniform(min_angle, max_angle, settings.IMAGE_VAL_SET_SIZE)
-        test_angles = np.random.uniform(min_angle, max_angle, settings.IMAGE_TEST_SET_SIZE)
+        val_angles = rng.uniform(min_angle, max_angle, settings.IMAGE_VAL_SET_SIZE)
+        test_angles = rng.uniform(min_angle, max_angle, settings.IMAGE_TEST_SET_SIZE)
         angles = {'train': train_angles, 'val': val_angles, 'test': test_angles}
         return angles
 
     def init_datasets(self,
                       sets: list = ('train', 'val', 'test')):
         datasets = {}
+        if settings.STREAM_TRAIN_SET == 'True' and 'train' in sets:
+            # The train set is generated on the fly for every epoch
+            min_angle = float(self.calibration['needle']['min_angle'])
+            max_angle = float(self.calibration['needle']['max_angle'])
+            datasets['train'] = img_dataset.AnalogStreamDataSet(calibration=self.calibration,
+                                                                base_image=self.base_image,
+                                                                needle_image=self.needle_image,
+                                                                min_angle=min_angle,
+                                                                max_angle=max_angle)
+            sets = [set_type for set_type in sets if set_type != 'train']
+        images = dict.fromkeys(sets)
+        if settings.IN_MEMORY_DATASET == 'True':
+            # All the sets without a valid cache are generated in one parallel run
+            center = tuple(float(x) for x in self.calibration['center'])
+            stale = {}
+            for set_type in sets:
+                key = dcache.fingerprint(self.base_image, self.needle_image, center, self.angles[set_type])
+                if settings.DATASET_CACHE != 'True' or dcache.load_cache(key) is None:
+                    stale[set_type] = self.angles[set_type]
+            if stale:
+                images.update(dg.generate_sets(train_image=self.base_image,
+                                               needle_image=self.needle_image,
+                                               needle_center=center,
+                                               angles=stale))
         for set_type in sets:
             datasets[set_type] = img_dataset.AnalogDataSet(set_type=set_type,
                                                            base_image=self.base_image,
                                                            needle_image=self.needle_image,
                                                            angles=self.angles[set_type],
-                                                           calibration=self.calibration)
+                                                           calibration=self.calibration,
+                                                           images=images[set_type])
         return datasets
 
     def create_train_val_set(self):
         for set_type in ['train', 'val', 'test']:
-            self.datasets[set_type].create_dataset()
+            if isinstance(self.datasets[set_type], img_dataset.AnalogDataSet):
+                self.datasets[set_type].create_dataset()
         return None
 
     def init_data_loaders(self,
                           sets: list = ('train', 'val', 'test')):
         for set_type in sets:
+            if isinstance(self.datasets[set_type], img_dataset.AnalogStreamDataSet):
+                # The stream yields ready batches, generated by the loader's workers
+                self.data_loaders[set_type] = DataLoader(self.datasets[set_type],
+                                                         batch_size=None,
+                                                         num_workers=settings.NUM_WORKERS)
+                continue
             self.data_loaders[set_type] = DataLoader(self.datasets[set_type],
                                                      batch_size=settings.BATCH_SIZE,
                                                      shuffle=False)
@@ -183,6 +399,9 @@ class AnalogGauge(Gauge):
                                   val_loader=self.data_loaders['val'],
                                   test_loader=self.data_loaders['test'],
                                   transfer_learning=transfer_learning)
+        # Cached models and readings of the gauge are stale
+        mc.MODEL_CACHE.invalidate(self.directory)
+        self.change_gate.reset()
         return None
 
     def visual_test(self,
@@ -190,11 +409,14 @@ class AnalogGauge(Gauge):
         """
         Test the model's performance.
         """
+        import matplotlib.pyplot as plt
         typer.secho(f'Testing model on {settings.DEVICE}', fg=typer.colors.CYAN)
-        if model is None:
-            model = self.model
-        test_path = os.path.join(self.directory, 'test')
-        test_images = [os.path.join(test_path, x) for x in os.listdir(test_path)]
+        self.init_training_data(sets=['test'])
+        if self.datasets['test'].in_memory:
+            test_images = list(self.datasets['test'].images)
+        else:
+            test_path = os.path.join(self.directory, 'test')
+            test_images = [os.path.join(test_path, x) for x in os.listdir(test_path)]
         size = settings.TEST_REPORT_IMAGE_TILE
         fig_shape = [size] * 2
         fig_size = [settings.REPORT_PLT_SIZE] * 2
@@ -205,9 +427,11 @@ class AnalogGauge(Gauge):
             pred_value = self.get_reading(frame=image,
                                           model=model,
                                           restore_edit_steps=False,
-                                          prints=False)
+                                          prints=False,
+                                          gate=False,
+                                          polar_mode='off')
             fig.add_subplot(fig_shape[0], fig_shape[1], i)
-            figure = cv2.imread(image)
+            figure = cv2.imread(image) if isinstance(image, str) else cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
             plt.imshow(figure)
             plt.axis('off')
             pred_value = round(pred_value, 2)
@@ -220,66 +444,187 @@ class AnalogGauge(Gauge):
         typer.echo(f'Test results saved to {self.directory}')
 
     def get_reading(self,
-                    frame: str or np.ndarray,
+                    frame: str or bytes or ie.RawFrame or np.ndarray,
                     model: gn.GaugeNet = None,
                     restore_edit_steps: bool = True,
-                    prints: bool = True):
+                    prints: bool = True,
+                    gate: bool = settings.CHANGE_GATING == 'True',
+                    polar_mode: str = settings.POLAR_MODE):
         """
         Get the reading of the gauge.
-        :param model:
-        :param frame:
+        :param model: optional, GaugeNet model or inference backend. If not specified, the gauge's inference model
+        :param frame: file name in the frames directory, encoded image, RawFrame or image
         :param restore_edit_steps: Perform the edit steps as saved in the XML file
         :param prints: Print the results
+        :param gate: Reuse the last reading when the gauge's ROI did not change (only with the gauge's own model)
+        :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
         :return:
         """
-        model = model if model else self.model
-        crop_coords = None
-        perspective_pts = None
-        perspective_changed = False
-        if isinstance(frame, str):
-            path = (Path(settings.FRAMES_PATH) / frame).as_posix()
-            frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if frame is None:
-                raise FileNotFoundError(f'Image not found: {path}')
-        if restore_edit_steps:
-            crop_coords = self.calibration['crop']
-            crop_coords = [int(x) for x in crop_coords]
-            perspective_pts = self.calibration['perspective']
-            if isinstance(perspective_pts[0], str):
-                perspective_pts = [pts.strip('[').strip(']').split(',') for pts in perspective_pts]
-            perspective_pts = [tuple(int(x) for x in pts) for pts in perspective_pts]
-            perspective_changed = self.calibration['perspective_changed']
-            perspective_changed = True if perspective_changed == 'True' else False
-        image = ie.frame_to_read_image(frame=frame,
-                                       crop_coords=crop_coords,
-                                       perspective_pts=perspective_pts,
-                                       perspective_changed=perspective_changed)
-        rad = model(image)
+        gate = gate and model is None and restore_edit_steps
+        image = self.frame_to_image(frame=frame,
+                                    restore_edit_steps=restore_edit_steps)
+        if gate:
+            current, reading = self.change_gate.lookup(image, polar_mode)
+            if reading is not None:
+                if prints:
+                    self.print_reading(reading)
+                return reading
+        rad = self.predict(image, model=model, polar_mode=polar_mode)
         reading = self.get_value(rad=rad)
+        if gate:
+            self.change_gate.store(current, reading, polar_mode)
         if prints:
-            time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            typer.echo('Time: {} | Gauge: {} | Camera: {} | Reading: {:.2f} {}'.format(time,
-                                                                                       self.calibration['index'],
-                                                                                       self.calibration['camera_id'],
-                                                                                       reading,
-                                                                                       self.calibration['units']))
+            self.print_reading(reading)
         return reading
 
+    def predict(self,
+                images: torch.Tensor,
+                model: gn.GaugeNet = None,
+                polar_mode: str = settings.POLAR_MODE) -> torch.Tensor:
+        """
+        Predict the needle angles of a batch of model inputs with the gauge's model, its polar needle estimator or
+        both: 'off' uses the model only, 'primary' uses the estimator and the model only for the images whose estimate
+        is not confident, 'cross_check' uses the model and reports its disagreements with a confident estimate,
+        'fallback' uses the estimator when the model is missing or predicts an angle outside the gauge's range.
+        Every reading path of the gauge goes through it.
+        :param images: model inputs of shape (N, 1, H, W)
+        :param model: optional, GaugeNet model or inference backend. If not specified, the gauge's inference model
+        :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
+        :return: predicted angles (radians) of shape (N, 1)
+        """
+        if polar_mode not in pe.MODES:
+            raise ValueError(f'Unknown polar mode "{polar_mode}", must be one of {", ".join(pe.MODES)}')
+        # Rows of the images read by the model
+        rows = np.arange(len(images))
+        if polar_mode == 'primary':
+            rad, confident = self.polar_estimator.predict(images)
+            self.polar_counts['polar'] += int(confident.sum())
+            rows = np.flatnonzero(~confident)
+            if not len(rows):
+                return rad
+        else:
+            rad = torch.zeros((len(images), 1), dtype=torch.float32)
+        try:
+            model = model if model else self.inference_model
+        except FileNotFoundError:
+            if polar_mode != 'fallback':
+                raise
+            self.polar_counts['polar'] += len(images)
+            return self.polar_estimator(images)
+        with torch.inference_mode():
+            value = model(images if len(rows) == len(images) else images[torch.from_numpy(rows)])
+        value = value.detach().cpu() if isinstance(value, torch.Tensor) else torch.from_numpy(np.asarray(value))
+        rad[torch.from_numpy(rows)] = value.float().reshape(-1, 1)
+        self.polar_counts['model'] += len(rows)
+        angles = np.rad2deg(rad.numpy().astype(np.float64).reshape(-1))
+        if polar_mode == 'cross_check':
+            polar, confident = self.polar_estimator.predict(images)
+            differences = np.abs(pe.wrap_angle(np.rad2deg(polar.numpy().astype(np.float64).reshape(-1)) - angles))
+            for difference in differences[confident & (differences > settings.POLAR_TOLERANCE)]:
+                self.polar_counts['disagreements'] += 1
+                typer.secho(f'Gauge {self.calibration["index"]}: model and polar estimate differ by '
+                            f'{difference:.1f} degrees', fg='yellow')
+        elif polar_mode == 'fallback':
+            limits = [float(self.calibration['needle'][key]) for key in ['min_angle', 'max_angle']]
+            outside = np.flatnonzero((angles < min(limits) - settings.POLAR_TOLERANCE) |
+                                     (angles > max(limits) + settings.POLAR_TOLERANCE))
+            if len(outside):
+                polar, confident = self.polar_estimator.predict(images[torch.from_numpy(outside)])
+                rad[torch.from_numpy(outside[confident])] = polar[torch.from_numpy(confident)]
+                self.polar_counts['polar'] += int(confident.sum())
+        return rad
+
+    def get_readings(self,
+                     frames,
+                     model: gn.GaugeNet = None,
+                     restore_edit_steps: bool = True,
+                     prints: bool = False,
+                     polar_mode: str = settings.POLAR_MODE) -> np.ndarray:
+        """
+        Get the readings of the gauge for a batch of frames, using a single forward pass of the model.
+        :param frames: list or generator of frames (file names, encoded images, RawFrames or images), or a stacked
+        ndarray of frames
+        :param model: optional, GaugeNet model or inference backend. If not specified, the gauge's inference model
+        :param restore_edit_steps: Perform the edit steps as saved in the XML file
+        :param prints: Print the results
+        :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
+        :return: ndarray of readings, one per frame
+        """
+        images = [self.frame_to_image(frame=frame,
+                                      restore_edit_steps=restore_edit_steps) for frame in frames]
+        if not images:
+            return np.empty(0)
+        rad = self.predict(torch.cat(images), model=model, polar_mode=polar_mode)
+        readings = self.get_values(rad=rad)
+        if prints:
+            for reading in readings:
+                self.print_reading(reading)
+        return readings
+
+    def frame_to_image(self,
+                       frame: str or bytes or ie.RawFrame or np.ndarray,
+                       restore_edit_steps: bool = True,
+                       factor: int = 1,
+                       shape: tuple = None) -> torch.Tensor:
+        """
+        Load a frame (if a file name is given), decode it (if encoded) or wrap it (if raw) and convert it to the
+        model's input tensor. Frame files and encoded frames are decoded at a reduced resolution when the crop allows it.
+        :param frame: file name in the frames directory, encoded image, RawFrame or image
+        :param restore_edit_steps: Perform the edit steps as saved in the XML file
+        :param factor: reduction factor an image was decoded at
+        :param shape: full resolution (h, w) of a reduced image
+        :return: image tensor of shape (1, 1, H, W)
+        """
+        plan = self.get_read_plan(restore_edit_steps=restore_edit_steps)
+        if not isinstance(frame, np.ndarray):
+            frame, factor, shape = rp.decode_frame(frame, [plan], self.frame_shape)
+            self.set_decode(factor, shape)
+        return plan.to_read_image(frame, factor=factor, shape=shape)
+
+    def set_decode(self,
+                   factor: int,
+                   shape: tuple):
+        """
+        Keep the full resolution shape of the last frame, used to pick the reduction factor of the next decode,
+        and report the reduction factor when it changes.
+        :param factor: reduction factor of the last decode
+        :param shape: full resolution (h, w) of the last frame
+        :return: None
+        """
+        self.frame_shape = tuple(shape)
+        if factor != self.decode_factor:
+            self.decode_factor = factor
+            typer.secho(f'Gauge {self.calibration["index"]}: frames decoded at 1/{factor} resolution', fg='blue')
+
+    def print_reading(self,
+                      reading: float):
+        """
+        Print a reading of the gauge with the current time.
+        :param reading: gauge value
+        :return: None
+        """
+        time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        typer.echo('Time: {} | Gauge: {} | Camera: {} | Reading: {:.2f} {}'.format(time,
+                                                                                   self.calibration['index'],
+                                                                                   self.calibration['camera_id'],
+                                                                                   reading,
+                                                                                   self.calibration['units']))
+
     def get_value(self,
                   rad: torch.Tensor):
         """
         Converts angle to value
         """
-        min_angle = float(self.calibration['needle']['min_angle'])
-        angle = np.rad2deg(rad.item())
-        if angle > 0:
-            min_rel_angle = min_angle - angle
-        else:
-            min_rel_angle = min_angle + abs(angle)
-        value_step = float(self.calibration['step_value'])
-        value = min_rel_angle * value_step
-        min_val = float(self.calibration['min_value'])
-        return min_val + value
+        return float(self.get_values(rad=rad)[0])
+
+    def get_values(self,
+                   rad: torch.Tensor or np.ndarray) -> np.ndarray:
+        """
+        Converts a batch of angles (radians) to values
+        :param rad: model output of shape (N, 1) or (N,)
+        :return: ndarray of values of shape (N,)
+        """
+        return self.get_read_plan().to_values(rad)
 
     @classmethod
     def calibrate(cls,
@@ -293,6 +638,8 @@ class AnalogGauge(Gauge):
         :param camera_id: Camera ID of the gauge.
         :return: None
         """
+        # The calibrator (tkinter) is only imported when calibrating
+        import src.calibrator.app as calibrator
         directory_path, index = env.set_gauge_directory(index, camera_id)
         calibrator_app = calibrator.AnalogCalibrator()
         calibration = calibrator_app.run(index=index,
@@ -300,3 +647,14 @@ class AnalogGauge(Gauge):
                                          frame_name=calibration_image,
                                          directory=directory_path)
         return calibration
+
+
+def warm_up(xml_files: list = settings.MODEL_CACHE_WARM_UP) -> dict:
+    """
+    Load the models of a list of gauges into the process-wide model cache, ahead of their first readings
+    :param xml_files: calibration XML files of the gauges
+    :return: dict of the model cache counters
+    """
+    gauges = [AnalogGauge(xml_file) for xml_file in xml_files]
+    mc.MODEL_CACHE.warm_up([(gauge.model_key, gauge.load_backend) for gauge in gauges])
+    return mc.MODEL_CACHE.stats()
@@ -0,0 +1,103 @@
+import os
+import torch
+import typer
+
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import src.gauges.gauge as g
+
+from config import settings
+
+
+def thread_counts(workers: int,
+                  intra_op_threads: int = settings.TORCH_INTRA_OP_THREADS,
+                  inter_op_threads: int = settings.TORCH_INTER_OP_THREADS) -> tuple:
+    """
+    Torch thread counts for a number of reading workers. By default the cores are split between the workers, so
+    the workers' intra-op threads do not oversubscribe the cores
+    :param workers: number of reading workers
+    :param intra_op_threads: intra-op threads (0 to split the cores between the workers)
+    :param inter_op_threads: inter-op threads (0 for the torch default)
+    :return: (intra-op threads, inter-op threads)
+    """
+    cores = os.cpu_count() or 1
+    intra_op_threads = int(intra_op_threads) or max(1, cores // workers)
+    inter_op_threads = int(inter_op_threads) or torch.get_num_interop_threads()
+    return intra_op_threads, inter_op_threads
+
+
+def configure_threads(intra_op_threads: int,
+                      inter_op_threads: int):
+    """
+    Set the process-wide torch thread counts. The inter-op thread count can only be set before the first parallel
+    torch work, a later change is ignored with a warning
+    :param intra_op_threads: intra-op threads
+    :param inter_op_threads: inter-op threads
+    :return: None
+    """
+    torch.set_num_threads(intra_op_threads)
+    if torch.get_num_interop_threads() != inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            typer.secho(f'Inter-op threads already set to {torch.get_num_interop_threads()}', fg='yellow')
+
+
+class ReadingEngine:
+    def __init__(self,
+                 workers: int = settings.ENGINE_WORKERS,
+                 intra_op_threads: int = settings.TORCH_INTRA_OP_THREADS,
+                 inter_op_threads: int = settings.TORCH_INTER_OP_THREADS):
+        """
+        Thread-safe concurrent reading engine. Readings run on a pool of worker threads, each with its own
+        preprocessing buffers, over models shared through the model cache (in eval and inference mode).
+        :param workers: number of worker threads (0 for one per core)
+        :param intra_op_threads: torch intra-op threads (0 to split the cores between the workers)
+        :param inter_op_threads: torch inter-op threads (0 for the torch default)
+        """
+        self.workers = int(workers) or os.cpu_count() or 1
+        self.intra_op_threads, self.inter_op_threads = thread_counts(self.workers, intra_op_threads, inter_op_threads)
+        configure_threads(self.intra_op_threads, self.inter_op_threads)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reading')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def read(gauge: g.AnalogGauge,
+             frame) -> float:
+        """
+        Get a reading of a gauge on the calling thread
+        :param gauge: AnalogGauge
+        :param frame: file name in the frames directory, encoded image, RawFrame or image
+        :return: gauge value
+        """
+        image = gauge.frame_to_image(frame)
+        return gauge.get_value(rad=gauge.predict(image))
+
+    def submit(self,
+               gauge: g.AnalogGauge,
+               frame) -> Future:
+        """
+        Get a reading of a gauge on a worker thread
+        :param gauge: AnalogGauge
+        :param frame: file name in the frames directory, encoded image, RawFrame or image
+        :return: future of the gauge value
+        """
+        return self.executor.submit(self.read, gauge, frame)
+
+    def read_many(self,
+                  requests: list) -> list:
+        """
+        Get the readings of a list of requests concurrently
+        :param requests: list of (gauge, frame)
+        :return: list of gauge values, in the requests order
+        """
+        futures = [self.submit(gauge, frame) for gauge, frame in requests]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,148 @@
+import os
+import torch
+import numpy as np
+
+import src.model.quantization as quantization
+from config import settings
+
+
+class InferenceBackend:
+    name = None
+
+    def __call__(self,
+                 images: torch.Tensor or np.ndarray) -> np.ndarray:
+        """
+        Predict the needle angles of a batch of images.
+        :param images: model input of shape (N, 1, H, W)
+        :return: predicted angles (radians) of shape (N, 1)
+        """
+        raise NotImplementedError
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate resident size of the backend's model (bytes)
+        """
+        return 0
+
+
+class TorchBackend(InferenceBackend):
+    name = 'torch'
+
+    def __init__(self,
+                 model: torch.nn.Module,
+                 device: str = settings.DEVICE):
+        """
+        Run a GaugeNet model with PyTorch.
+        :param model: GaugeNet model, put in eval mode without gradients once, so it can be shared by threads
+        :param device: device the model runs on
+        """
+        self.model = model.eval()
+        for parameter in self.model.parameters():
+            parameter.requires_grad_(False)
+        self.device = device
+
+    def __call__(self,
+                 images: torch.Tensor or np.ndarray) -> np.ndarray:
+        if isinstance(images, np.ndarray):
+            images = torch.from_numpy(images)
+        with torch.inference_mode():
+            return self.model(images.to(self.device)).cpu().numpy()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.model.state_dict().values()
+                   if isinstance(t, torch.Tensor))
+
+
+class QuantizedBackend(TorchBackend):
+    name = 'int8'
+
+    def __init__(self,
+                 model: torch.nn.Module,
+                 path: str = None):
+        """
+        Run a quantized (int8) GaugeNet model with PyTorch on the CPU.
+        :param model: QuantizedGaugeNet model
+        :param path: optional, path to the int8 .pt file, used to size the model
+        """
+        super().__init__(model, device='cpu')
+        self.path = path
+
+    @property
+    def nbytes(self) -> int:
+        # The packed int8 weights are not in the state_dict
+        return os.path.getsize(self.path) if self.path else super().nbytes
+
+
+class OnnxBackend(InferenceBackend):
+    name = 'onnx'
+
+    def __init__(self,
+                 path: str,
+                 threads: int = 0):
+        """
+        Run an exported GaugeNet model with ONNX Runtime on the CPU.
+        :param path: path to the .onnx file
+        :param threads: optional, number of intra-op threads (0 for the ONNX Runtime default)
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('The ONNX backend requires onnxruntime, install it with "pip install onnxruntime"')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'ONNX model not found: {path}')
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self,
+                 images: torch.Tensor or np.ndarray) -> np.ndarray:
+        if isinstance(images, torch.Tensor):
+            images = images.detach().cpu().numpy()
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        return self.session.run(None, {self.input_name: images})[0]
+
+    @property
+    def nbytes(self) -> int:
+        paths = [self.path, self.path + '.data']
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def onnx_path(directory: str,
+              version: str = settings.MODEL_VERSION,
+              epoch: str = settings.DEFAULT_MODEL_TYPE) -> str:
+    """
+    Path of the exported ONNX model of a gauge
+    :param directory: Gauge directory
+    :param version: version of the model
+    :param epoch: epoch of the model ('best', 'last')
+    :return: path to the .onnx file
+    """
+    return os.path.join(directory, f'gauge_net_v{version}_{epoch}.onnx')
+
+
+def load_backend(name: str,
+                 model: torch.nn.Module = None,
+                 directory: str = None,
+                 version: str = settings.MODEL_VERSION,
+                 epoch: str = settings.DEFAULT_MODEL_TYPE) -> InferenceBackend:
+    """
+    Load an inference backend for a gauge
+    :param name: backend name, one of 'torch', 'onnx', 'int8'
+    :param model: GaugeNet model, used by the torch backend
+    :param directory: Gauge directory, used by the onnx and int8 backends
+    :param version: version of the model
+    :param epoch: epoch of the model ('best', 'last')
+    :return: InferenceBackend
+    """
+    if name == TorchBackend.name:
+        return TorchBackend(model)
+    if name == OnnxBackend.name:
+        return OnnxBackend(onnx_path(directory, version, epoch))
+    if name == QuantizedBackend.name:
+        return QuantizedBackend(quantization.load(directory, version, epoch),
+                                path=quantization.quantized_path(directory, version, epoch))
+    raise ValueError(f'Unknown inference backend "{name}", must be one of torch, onnx, int8')
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from config import settings
+
+# Bumped whenever the composited images change, so older cached datasets are regenerated
+CACHE_VERSION = 2
+
+
+def fingerprint(base_image: np.ndarray,
+                needle_image: np.ndarray,
+                center: tuple,
+                angles: np.ndarray) -> str:
+    """
+    Fingerprint of the inputs of a synthetic dataset (images, center, angles and output size), used as the
+    dataset's cache address. Any change to the inputs gives a new address
+    :param base_image: base image (without the needle)
+    :param needle_image: needle image
+    :param center: needle rotation center (x, y)
+    :param angles: needle angles (degrees)
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for array in [base_image, needle_image, np.asarray(center, dtype=np.float64), np.asarray(angles, dtype=np.float64)]:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    digest.update(f'{CACHE_VERSION}|{list(settings.TRAIN_IMAGE_SHAPE)}|{settings.COMPOSITE_SUPERSAMPLE}'.encode())
+    return digest.hexdigest()
+
+
+def cache_paths(key: str) -> tuple:
+    """
+    Paths of the cached images (.npy) and cache header (.json) of a dataset. The cache is content-addressed:
+    datasets generated from the same inputs (by any gauge) share the same files
+    :param key: fingerprint of the dataset's inputs
+    :return: (images path, header path)
+    """
+    directory = os.path.join(settings.DATASETS_PATH, key)
+    return os.path.join(directory, 'images.npy'), os.path.join(directory, 'header.json')
+
+
+def load_cache(key: str) -> np.ndarray or None:
+    """
+    Open a dataset's cached images as a read-only memory map, processes opening the same cache share its pages
+    :param key: fingerprint of the dataset's inputs
+    :return: uint8 memory map of shape (N, H, W), or None if there is no valid cache
+    """
+    images_path, header_path = cache_paths(key)
+    try:
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        if header['fingerprint'] != key:
+            return None
+        images = np.load(images_path, mmap_mode='r')
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    if list(images.shape) != header['shape']:
+        return None
+    return images
+
+
+def save_cache(key: str,
+               images: np.ndarray) -> np.ndarray:
+    """
+    Write a dataset's images to the cache. The files are written aside and moved in place, so processes that
+    still map an older cache keep their pages, and the header is moved last so a partly written cache is never valid
+    :param key: fingerprint of the dataset's inputs
+    :param images: uint8 array of shape (N, H, W)
+    :return: read-only memory map of the cached images
+    """
+    images_path, header_path = cache_paths(key)
+    os.makedirs(os.path.dirname(images_path), exist_ok=True)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    temp_path = images_path + f'.{os.getpid()}.tmp.npy'
+    cached = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=images.shape)
+    cached[...] = images
+    cached.flush()
+    del cached
+    os.replace(temp_path, images_path)
+    header = {'fingerprint': key, 'shape': list(images.shape), 'version': CACHE_VERSION}
+    temp_path = header_path + f'.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(header, f)
+    os.replace(temp_path, header_path)
+    return np.load(images_path, mmap_mode='r')
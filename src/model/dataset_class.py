@@ -2,16 +2,69 @@ import os
 import shutil
 import typer
 import cv2
-import pandas as pd
 import numpy as np
-import skimage.io as io
 import PIL.Image as Image
+import torch
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
 import src.utils.image_editing as ie
+import src.model.dataset_generation as dg
+import src.model.dataset_cache as dcache
 from config import settings
 
+MANIFEST_COLS = ['image_name', 'augmented', 'real_angle', 'radians']
+
+
+def create_manifest(angles: np.ndarray) -> dict:
+    """
+    Create the columnar manifest of a synthetic dataset, one preallocated array per column
+    :param angles: needle angles (degrees)
+    :return: dict of column name to array
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    return {'image_name': np.array([f'{index:05d}.jpg' for index in range(1, len(angles) + 1)]),
+            'augmented': np.zeros(len(angles), dtype=bool),
+            'real_angle': angles,
+            'radians': np.radians(angles)}
+
+
+def save_manifest(manifest: dict,
+                  path: str,
+                  key: str = None):
+    """
+    Save a manifest to an uncompressed NumPy archive
+    :param manifest: dict of column name to array
+    :param path: path to the .npz file
+    :param key: optional, fingerprint of the dataset's inputs (see dcache.fingerprint)
+    :return: None
+    """
+    if key is not None:
+        manifest = dict(manifest, fingerprint=np.array(key))
+    np.savez(path, **manifest)
+
+
+def load_manifest(path: str,
+                  legacy_path: str = None) -> dict:
+    """
+    Load a manifest from a NumPy archive, or from the csv dataframe of older versions
+    :param path: path to the .npz file
+    :param legacy_path: optional, path to the csv file, used if the .npz file is not found
+    :return: dict of column name to array, and the fingerprint of the dataset's inputs if it was saved
+    """
+    try:
+        with np.load(path) as archive:
+            manifest = {col: archive[col] for col in MANIFEST_COLS}
+            if 'fingerprint' in archive.files:
+                manifest['fingerprint'] = str(archive['fingerprint'])
+            return manifest
+    except FileNotFoundError:
+        if legacy_path is None:
+            raise
+        import pandas as pd
+        df = pd.read_csv(legacy_path)
+        return {col: df[col].to_numpy() for col in MANIFEST_COLS}
+
 
 class ImageDataset(Dataset):
     def __init__(self,
@@ -29,6 +82,10 @@ class ImageDataset(Dataset):
         self.images_path = os.path.join(directory, set_type)
         self.gauge_directory = self.calibration['directory']
         self.report_path = os.path.join(self.gauge_directory, f'{self.set_type}_df.csv')
+        self.manifest_path = os.path.join(self.gauge_directory, f'{self.set_type}_manifest.npz')
+        self.manifest = None
+        self.image_names = None
+        self.radians = None
 
     def initialize_dir(self):
         """
@@ -42,8 +99,20 @@ class ImageDataset(Dataset):
     def __getitem__(self, index):
         pass
 
+    def set_manifest(self,
+                     manifest: dict):
+        """
+        Set the dataset's manifest and its hot path columns
+        :param manifest: dict of column name to array
+        :return: the manifest
+        """
+        self.manifest = manifest
+        self.image_names = manifest['image_name']
+        self.radians = manifest['radians']
+        return manifest
+
     def __len__(self):
-        return len(self.set_df)
+        return len(self.manifest['radians'])
 
 
 class AnalogDataSet(ImageDataset):
@@ -53,7 +122,10 @@ class AnalogDataSet(ImageDataset):
                  base_image: np.ndarray,
                  needle_image: np.ndarray,
                  angles: np.ndarray,
-                 transform=ie.process_image):
+                 transform=ie.process_image,
+                 in_memory: bool = settings.IN_MEMORY_DATASET == 'True',
+                 images: np.ndarray = None,
+                 cache: bool = settings.DATASET_CACHE == 'True'):
         super().__init__(set_type=set_type,
                          calibration=calibration,
                          transform=transform)
@@ -61,43 +133,148 @@ class AnalogDataSet(ImageDataset):
         self.base_image = base_image
         self.needle_image = needle_image
         self.angles = angles
+        self.in_memory = in_memory
+        self.generated = images
+        self.cache = cache
         # Inner variables
-        self.data_cols = ['image_name', 'augmented', 'real_angle', 'radians']
         center = self.calibration['center']
         self.center = tuple([float(x) for x in center])
+        self.images = None
+        self.cache_key = dcache.fingerprint(self.base_image, self.needle_image, self.center, self.angles)
+        if self.in_memory:
+            self.create_dataset()
+            return
         try:
-            self.set_df = pd.read_csv(os.path.join(self.gauge_directory, f'{self.set_type}_df.csv'))
+            manifest = load_manifest(self.manifest_path, legacy_path=self.report_path)
         except FileNotFoundError:
-            self.set_df = self.create_dataset()
+            self.create_dataset()
+            return
+        # Manifests without a fingerprint (csv manifests of older versions) may be stale
+        if manifest.get('fingerprint') != self.cache_key:
+            typer.secho(f'{self.set_type} set inputs changed or unknown, regenerating', fg='yellow')
+            self.create_dataset()
+            return
+        self.set_manifest(manifest)
+
+    def composite(self) -> np.ndarray:
+        """
+        Composite the needle on the base image at all the dataset's angles, unless the images were generated
+        beforehand (see dg.generate_sets)
+        :return: uint8 array of grayscale images of the train image shape
+        """
+        if self.generated is not None:
+            images, self.generated = self.generated, None
+            return images
+        return dg.composite_parallel(self.base_image, self.needle_image, self.center, self.angles)
 
     def create_dataset(self):
         """
         Creates the synthetic dataset from base image and needle image, angle list
-        :return:
+        :return: manifest
         """
-        self.set_df = pd.DataFrame(columns=self.data_cols)
+        if self.in_memory:
+            return self.create_memory_dataset()
+        manifest = self.set_manifest(create_manifest(self.angles))
         self.initialize_dir()
-        for index, angle in enumerate(self.angles, start=1):
-            image, _ = ie.rotate_needle(self.base_image, self.needle_image, self.center, angle)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            image_name = f'{index:05d}.jpg'
-            image = cv2.resize(image, settings.TRAIN_IMAGE_SHAPE)
+        for image_name, image in zip(manifest['image_name'], self.composite()):
             cv2.imwrite(os.path.join(self.images_path, image_name), image)
-            self.set_df = pd.concat([self.set_df,
-                                     pd.DataFrame([[image_name, False, angle, angle]],
-                                                  columns=self.data_cols)])
-        self.set_df['radians'] = self.set_df['radians'].apply(lambda x: np.radians(x))
-        self.set_df.to_csv(self.report_path, index=False)
-        return self.set_df
+        save_manifest(manifest, self.manifest_path, key=self.cache_key)
+        return manifest
+
+    def create_memory_dataset(self):
+        """
+        Creates the synthetic dataset straight into a uint8 image array and the manifest arrays, no JPEG images are
+        written to disk (see export). If caching is on, the images are read zero-copy from a memory-mapped cache
+        addressed by the fingerprint of the dataset's inputs, generated only if no gauge generated the same inputs
+        :return: manifest
+        """
+        if self.cache:
+            self.images = dcache.load_cache(self.cache_key)
+            if self.images is None:
+                self.images = dcache.save_cache(self.cache_key, self.composite())
+        else:
+            self.images = self.composite()
+        return self.set_manifest(create_manifest(self.angles))
+
+    def export(self):
+        """
+        Write the in-memory dataset to the dataset's directory (images and manifest), for inspection
+        :return: None
+        """
+        self.initialize_dir()
+        for index, image_name in enumerate(self.image_names):
+            cv2.imwrite(os.path.join(self.images_path, image_name), np.asarray(self.images[index]))
+        save_manifest(self.manifest, self.manifest_path, key=self.cache_key)
 
     def __getitem__(self, index):
-        image_path = os.path.join(self.images_path,
-                                  self.set_df.iloc[index]['image_name'])
-        image = io.imread(image_path)
+        if self.in_memory:
+            image = self.images[index]
+            if self.transform is ie.process_image:
+                # Same as ToTensor and Normalize(0.5, 0.5), without the PIL round trip
+                image = torch.from_numpy(image.astype(np.float32)).unsqueeze(0).div(255).sub(0.5).div(0.5)
+            elif self.transform is not None:
+                image = self.transform(Image.fromarray(np.asarray(image)))
+            return image, self.radians[index]
+        import skimage.io as io
+        image = io.imread(os.path.join(self.images_path, self.image_names[index]))
         image = Image.fromarray(image)
         if self.transform is not None:
             image = self.transform(image)
-        return image, self.set_df.iloc[index]['radians']
+        return image, self.radians[index]
+
+
+class AnalogStreamDataSet(IterableDataset):
+    def __init__(self,
+                 calibration: dict,
+                 base_image: np.ndarray,
+                 needle_image: np.ndarray,
+                 min_angle: float,
+                 max_angle: float,
+                 batch_size: int = settings.BATCH_SIZE,
+                 batches_per_epoch: int = settings.BATCH_MULTIPLIER,
+                 augment: bool = True):
+        """
+        Endless synthetic train set: every batch is composited on the fly from random angles and augmented
+        with batched tensor ops, so each epoch sees fresh data without any disk footprint. Iterating yields
+        batches_per_epoch ready batches, use it with DataLoader(batch_size=None).
+        :param calibration: gauge calibration dictionary
+        :param base_image: base image (without the needle)
+        :param needle_image: needle image
+        :param min_angle: min needle angle (degrees)
+        :param max_angle: max needle angle (degrees)
+        :param batch_size: number of images per batch
+        :param batches_per_epoch: number of batches per iteration (epoch)
+        :param augment: apply brightness, contrast and noise augmentation
+        """
+        super().__init__()
+        self.set_type = 'train'
+        self.calibration = calibration
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+        self.batch_size = batch_size
+        self.batches_per_epoch = batches_per_epoch
+        self.augment = augment
+        center = tuple([float(x) for x in self.calibration['center']])
+        # The needle is prepared once, only the rotation and blending run per batch
+        self.base, self.needle, self.center = ie.prepare_composite(base_image, needle_image, center)
+
+    def __iter__(self):
+        # torch seeds the main process and every DataLoader worker differently for each epoch
+        generator = torch.Generator().manual_seed(int(torch.randint(0, 2 ** 31 - 1, (1,)).item()))
+        # Every DataLoader worker iterates its own copy, split the epoch's batches between them
+        worker = get_worker_info()
+        batches = range(self.batches_per_epoch)
+        if worker is not None:
+            batches = batches[worker.id::worker.num_workers]
+        for _ in batches:
+            angles = self.min_angle + (self.max_angle - self.min_angle) * torch.rand(self.batch_size,
+                                                                                     generator=generator,
+                                                                                     dtype=torch.float64)
+            images = ie.composite_prepared(self.base, self.needle, self.center, angles.numpy())
+            images = torch.from_numpy(images).unsqueeze(1).float().div(255)
+            if self.augment:
+                images = ie.augment_batch(images, generator=generator)
+            yield images.sub(0.5).div(0.5), torch.deg2rad(angles)
 
     def __len__(self):
-        return len(self.set_df)
+        return self.batches_per_epoch
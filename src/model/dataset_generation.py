@@ -0,0 +1,134 @@
+import os
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import src.utils.image_editing as ie
+from config import settings
+
+def _to_shared(array: np.ndarray) -> tuple:
+    """
+    Copy an array to a new shared memory block
+    :param array: array to share
+    :return: shared memory block, spec (name, shape, dtype) used by the workers to attach it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _composite_shard(specs: dict,
+                     start: int,
+                     angles: np.ndarray,
+                     center: tuple,
+                     shape: tuple) -> tuple:
+    """
+    Composite a slice of the angle array straight into the shared output array. The worker attaches the shared
+    base image, needle and output arrays for the slice and closes them when done
+    :param specs: dict of array name to shared memory spec
+    :param start: index of the first angle of the slice in the full angle array
+    :param angles: slice of the angle array
+    :param center: prepared needle center
+    :param shape: output (width, height)
+    :return: (start, stop) of the written rows
+    """
+    stop = start + len(angles)
+    blocks = {}
+    arrays = {}
+    try:
+        for key, (name, array_shape, dtype) in specs.items():
+            blocks[key] = shared_memory.SharedMemory(name=name)
+            arrays[key] = np.ndarray(array_shape, dtype=np.dtype(dtype), buffer=blocks[key].buf)
+        ie.composite_prepared(arrays['base'], arrays['needle'], center, angles, shape=shape,
+                              out=arrays['images'][start:stop])
+        return start, stop
+    finally:
+        # The arrays export the blocks' buffers, drop them before closing
+        arrays.clear()
+        for shm in blocks.values():
+            shm.close()
+
+
+def generation_workers(n_angles: int,
+                       workers: int = None) -> int:
+    """
+    Number of worker processes used to generate n_angles images, at least GENERATION_SHARD_SIZE angles per worker
+    :param n_angles: number of angles
+    :param workers: optional, max number of workers. If not specified, GENERATION_WORKERS (0 for all the cores)
+    :return: number of workers
+    """
+    if workers is None:
+        workers = int(settings.GENERATION_WORKERS) or os.cpu_count() or 1
+    return max(1, min(workers, n_angles // int(settings.GENERATION_SHARD_SIZE)))
+
+
+def composite_parallel(train_image: np.ndarray,
+                       needle_image: np.ndarray,
+                       needle_center: tuple,
+                       needle_angles: np.ndarray,
+                       shape: list = settings.TRAIN_IMAGE_SHAPE,
+                       workers: int = None) -> np.ndarray:
+    """
+    Parallel version of ie.composite_needles. The prepared base image and needle are shared with a process pool
+    through shared memory, each worker composites a slice of the angle array and writes it into one shared
+    output array, so no images are pickled between the processes.
+    :param train_image: base image (without the needle)
+    :param needle_image: needle image (black background)
+    :param needle_center: needle rotation center (x, y), in base image coordinates
+    :param needle_angles: array of N needle angles (degrees)
+    :param shape: output (width, height)
+    :param workers: optional, max number of worker processes
+    :return: uint8 array of N grayscale images of shape (N, height, width)
+    """
+    needle_angles = np.asarray(needle_angles, dtype=np.float64)
+    shape = tuple(shape)
+    base, needle, center = ie.prepare_composite(train_image, needle_image, needle_center, shape)
+    workers = generation_workers(len(needle_angles), workers)
+    if workers == 1:
+        return ie.composite_prepared(base, needle, center, needle_angles, shape)
+    blocks = {}
+    try:
+        specs = {}
+        for key, array in [('base', base),
+                           ('needle', needle),
+                           ('images', np.zeros((len(needle_angles), shape[1], shape[0]), dtype=np.uint8))]:
+            blocks[key], specs[key] = _to_shared(array)
+        shards = np.array_split(np.arange(len(needle_angles)), workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_composite_shard, specs, int(shard[0]), needle_angles[shard], center, shape)
+                       for shard in shards if len(shard)]
+            for future in futures:
+                future.result()
+        name, images_shape, dtype = specs['images']
+        return np.ndarray(images_shape, dtype=np.dtype(dtype), buffer=blocks['images'].buf).copy()
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+
+
+def generate_sets(train_image: np.ndarray,
+                  needle_image: np.ndarray,
+                  needle_center: tuple,
+                  angles: dict,
+                  workers: int = None) -> dict:
+    """
+    Generate the images of all the sets (train, val, test) in one parallel run over their merged angle arrays
+    :param train_image: base image (without the needle)
+    :param needle_image: needle image (black background)
+    :param needle_center: needle rotation center (x, y), in base image coordinates
+    :param angles: dict of set type to angle array
+    :param workers: optional, max number of worker processes
+    :return: dict of set type to uint8 image array
+    """
+    set_types = list(angles.keys())
+    merged = np.concatenate([np.asarray(angles[set_type], dtype=np.float64) for set_type in set_types])
+    images = composite_parallel(train_image, needle_image, needle_center, merged, workers=workers)
+    sets = {}
+    start = 0
+    for set_type in set_types:
+        stop = start + len(angles[set_type])
+        sets[set_type] = images[start:stop]
+        start = stop
+    return sets
@@ -1,16 +1,84 @@
 import os
 import time
 import torch
+import pickle
+import inspect
 import typer
 import torch.nn as nn
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
+import src.model.backends as backends
 from config import settings
 
 torch.manual_seed(settings.TORCH_SEED)
 
+# Checkpoint format: 1 for a pickled GaugeNet module (legacy), 2 for a state_dict with a metadata header
+CHECKPOINT_FORMAT = 2
+# torch.load/load_state_dict options missing in the installed torch, reported once per process
+_unsupported = set()
+
+
+def checkpoint_path(directory: str,
+                    version: str = settings.MODEL_VERSION,
+                    epoch: str = settings.DEFAULT_MODEL_TYPE) -> str:
+    """
+    Path of a GaugeNet checkpoint
+    :param directory: Gauge directory
+    :param version: version of the model
+    :param epoch: epoch of the model ('best', 'last')
+    :return: path to the .pt file
+    """
+    return os.path.join(directory, f'gauge_net_v{version}_{epoch}.pt')
+
+
+def save_checkpoint(checkpoint: dict,
+                    path: str):
+    """
+    Write a checkpoint aside and move it in place, so processes that memory-map the previous one keep their pages
+    :param checkpoint: dict with 'header' and 'state_dict'
+    :param path: path to the .pt file
+    :return: None
+    """
+    temp_path = path + f'.{os.getpid()}.tmp'
+    torch.save(checkpoint, temp_path)
+    os.replace(temp_path, path)
+
+
+def _report_unsupported(option: str):
+    """
+    Report once that the installed torch lacks a memory-mapped loading option, the weights are copied instead
+    :param option: name of the missing option
+    :return: None
+    """
+    if option not in _unsupported:
+        _unsupported.add(option)
+        typer.secho(f'torch {torch.__version__} does not support {option}, checkpoints are copied into memory',
+                    fg='yellow')
+
+
+def load_checkpoint(path: str,
+                    mmap: bool = True) -> dict or nn.Module:
+    """
+    Load a checkpoint on the CPU. With a torch version that supports it, the weights are memory-mapped (processes
+    loading the same checkpoint share its pages) and loaded without unpickling arbitrary objects
+    :param path: path to the .pt file
+    :param mmap: memory-map the weights when supported
+    :return: dict with 'header' and 'state_dict', or a GaugeNet module for the legacy format
+    """
+    supported = inspect.signature(torch.load).parameters
+    options = {'map_location': 'cpu'}
+    if mmap and 'mmap' in supported:
+        options['mmap'] = True
+    elif mmap:
+        _report_unsupported('torch.load(mmap=True)')
+    if 'weights_only' in supported:
+        try:
+            return torch.load(path, weights_only=True, **options)
+        except pickle.UnpicklingError:
+            # Legacy checkpoints are pickled modules
+            options['weights_only'] = False
+    return torch.load(path, **options)
+
 
 class GaugeNet(nn.Module):
     def __init__(self,
@@ -53,12 +121,31 @@ class GaugeNet(nn.Module):
 
         self.device = settings.DEVICE
         self.criterion = torch.nn.MSELoss()
-        self.optimizer = torch.optim.Adam(self.parameters(), lr=settings.LEARNING_RATE)
-        self.train_report = pd.DataFrame(columns=['epoch', 'train_loss', 'val_loss'])
+        self._optimizer = None
+        self._train_report = None
         self.best_epoch = 0
         self.best_loss = np.inf
         self.directory = directory
 
+    @property
+    def train_report(self):
+        """
+        Training report (pandas DataFrame), created on first use so pandas is only imported for training
+        """
+        if self._train_report is None:
+            import pandas as pd
+            self._train_report = pd.DataFrame(columns=['epoch', 'train_loss', 'val_loss'])
+        return self._train_report
+
+    @property
+    def optimizer(self) -> torch.optim.Optimizer:
+        """
+        The optimizer is created on first use, so models loaded for inference do not hold one
+        """
+        if self._optimizer is None:
+            self._optimizer = torch.optim.Adam(self.parameters(), lr=settings.LEARNING_RATE)
+        return self._optimizer
+
     def train_one_epoch(self,
                         train_loader):
         running_loss = 0.0
@@ -153,6 +240,7 @@ class GaugeNet(nn.Module):
         test_loss = self.test_validation_sequence(test_loader, report=True, epoch=epoch, set_name='test')
         self.print_loss(val_loss, test_loss, epoch=epoch)
 
+        import matplotlib.pyplot as plt
         path = os.path.join(self.directory, 'train_report.csv')
         self.train_report.to_csv(path, index=False)
         self.train_report.plot(x='epoch', y=['train_loss', 'val_loss'], title='Training Report')
@@ -170,6 +258,7 @@ class GaugeNet(nn.Module):
         :return:
         """
         if report:
+            import pandas as pd
             df_report = pd.DataFrame(columns=['real_angle', 'predicted_angle'])
         if epoch == 'best':
             model = self.load(directory=self.directory, epoch=epoch)
@@ -195,15 +284,57 @@ class GaugeNet(nn.Module):
              directory: str = None,
              epoch: str = None):
         """
-        Saves the model to the directory specified in the environment file.
+        Saves the model weights (state_dict) and a metadata header to the directory specified in the environment file.
         :return:
         """
         if directory is None:
             directory = self.directory
-        path = os.path.join(directory, f'gauge_net_v{settings.MODEL_VERSION}_{epoch}.pt')
+        path = checkpoint_path(directory, epoch=epoch)
         if not os.path.exists(directory):
             os.makedirs(settings.MODELS_PATH)
-        torch.save(self, path)
+        save_checkpoint({'header': self.header(epoch=epoch), 'state_dict': self.state_dict()}, path)
+
+    def header(self,
+               epoch: str = None) -> dict:
+        """
+        Metadata header of a checkpoint
+        :param epoch: epoch name of the checkpoint ('best', 'last')
+        :return: dict of the checkpoint format, model version, epoch, validation loss and input shape
+        """
+        if epoch == 'best' or self._train_report is None or not len(self._train_report):
+            epoch_index, loss = self.best_epoch, self.best_loss
+        else:
+            epoch_index, loss = self.train_report['epoch'].iloc[-1], self.train_report['val_loss'].iloc[-1]
+        return {'format': CHECKPOINT_FORMAT,
+                'version': settings.MODEL_VERSION,
+                'epoch_type': epoch,
+                'epoch': int(epoch_index),
+                'loss': float(loss),
+                'input_shape': [1] + list(settings.TRAIN_IMAGE_SHAPE[::-1])}
+
+    def export_onnx(self,
+                    directory: str = None,
+                    epoch: str = settings.DEFAULT_MODEL_TYPE) -> str:
+        """
+        Exports the model to ONNX with a dynamic batch dimension, for the ONNX Runtime inference backend.
+        :param directory: optional, directory to export to. If not specified, the gauge directory is used
+        :param epoch: epoch name of the exported model ('best', 'last')
+        :return: path to the .onnx file
+        """
+        if directory is None:
+            directory = self.directory
+        path = backends.onnx_path(directory, epoch=epoch)
+        device = next(self.parameters()).device
+        dummy = torch.zeros([1, 1] + list(settings.TRAIN_IMAGE_SHAPE[::-1]), device=device)
+        self.train(False)
+        torch.onnx.export(self,
+                          dummy,
+                          path,
+                          input_names=['image'],
+                          output_names=['angle'],
+                          dynamic_axes={'image': {0: 'batch'}, 'angle': {0: 'batch'}},
+                          opset_version=13)
+        return path
 
     def forward(self, x):
         """
@@ -218,16 +349,55 @@ class GaugeNet(nn.Module):
     def load(cls,
              directory: str = None,
              version: str = settings.MODEL_VERSION,
-             epoch: str = settings.DEFAULT_MODEL_TYPE):
+             epoch: str = settings.DEFAULT_MODEL_TYPE,
+             mmap: bool = True):
         """
-        Loads the model from the directory specified in the environment file
+        Loads the model from the directory specified in the environment file. Legacy (pickled module) checkpoints
+        are still readable, only their weights are kept
         :param directory: Gauge directory
         :param version: optional, version of the model to load. if not specified, the default version is loaded
         :param epoch: optional, epoch of the model to load. if not specified, the best epoch is loaded
+        :param mmap: memory-map the weights when supported (CPU only), instead of copying them to the process
         :return: trained model from saved file
         """
-        path = os.path.join(directory, f'gauge_net_v{version}_{epoch}.pt')
-        return torch.load(path)
+        checkpoint = load_checkpoint(checkpoint_path(directory, version, epoch), mmap=mmap)
+        model = cls(directory=directory)
+        if isinstance(checkpoint, nn.Module):
+            model.load_state_dict(checkpoint.state_dict())
+            model.best_epoch = getattr(checkpoint, 'best_epoch', 0)
+            model.best_loss = getattr(checkpoint, 'best_loss', np.inf)
+            return model.to(settings.DEVICE)
+        header = checkpoint['header']
+        if header['input_shape'] != [1] + list(settings.TRAIN_IMAGE_SHAPE[::-1]):
+            raise ValueError(f'Checkpoint input shape {header["input_shape"]} does not match TRAIN_IMAGE_SHAPE')
+        if mmap and 'assign' in inspect.signature(model.load_state_dict).parameters:
+            # The parameters keep pointing to the memory-mapped weights
+            model.load_state_dict(checkpoint['state_dict'], assign=True)
+        else:
+            if mmap:
+                _report_unsupported('load_state_dict(assign=True)')
+            model.load_state_dict(checkpoint['state_dict'])
+        if epoch == 'best':
+            model.best_epoch, model.best_loss = header['epoch'], header['loss']
+        return model.to(settings.DEVICE)
+
+    @classmethod
+    def migrate(cls,
+                directory: str,
+                version: str = settings.MODEL_VERSION,
+                epoch: str = settings.DEFAULT_MODEL_TYPE):
+        """
+        Rewrites a legacy (pickled module) checkpoint in the state_dict format
+        :param directory: Gauge directory
+        :param version: optional, version of the model to migrate
+        :param epoch: optional, epoch of the model to migrate
+        :return: migrated model
+        """
+        model = cls.load(directory=directory, version=version, epoch=epoch, mmap=False)
+        save_checkpoint({'header': dict(model.header(epoch=epoch), version=version),
+                         'state_dict': model.state_dict()},
+                        checkpoint_path(directory, version, epoch))
+        return model
 
     @staticmethod
     def print_loss(val_loss: float,
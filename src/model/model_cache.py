@@ -0,0 +1,142 @@
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from config import settings
+
+
+def model_nbytes(model) -> int:
+    """
+    Resident size of a cached model
+    :param model: GaugeNet model or inference backend
+    :return: size in bytes
+    """
+    if hasattr(model, 'nbytes'):
+        return int(model.nbytes)
+    if hasattr(model, 'state_dict'):
+        return sum(t.numel() * t.element_size() for t in model.state_dict().values() if hasattr(t, 'numel'))
+    return 0
+
+
+class ModelCache:
+    def __init__(self,
+                 budget: int = int(settings.MODEL_CACHE_BUDGET_MB * 2 ** 20)):
+        """
+        Process-wide LRU cache of loaded models, keyed by (gauge directory, version, epoch type, backend).
+        The least recently used models are evicted once the cached models exceed the memory budget. Models are loaded
+        outside of the lock, concurrent misses of the same key wait for a single load.
+        :param budget: memory budget (bytes). The most recently used model is kept even if it exceeds the budget
+        """
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._models = OrderedDict()
+        self._sizes = {}
+        # Future of the model of the keys being loaded
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key: tuple):
+        return key in self._models
+
+    def get(self,
+            key: tuple,
+            loader):
+        """
+        Get a model from the cache, loading it on a miss
+        :param key: (gauge directory, version, epoch type, backend)
+        :param loader: callable that loads the model
+        :return: cached model
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key]
+            self.misses += 1
+            waiting = key in self._loading
+            if not waiting:
+                self._loading[key] = Future()
+            future = self._loading[key]
+        if waiting:
+            return future.result()
+        try:
+            model = loader()
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(key) is future:
+                    del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            # Not kept if the key was invalidated while it was loading
+            if self._loading.get(key) is future:
+                del self._loading[key]
+                self._models[key] = model
+                self._sizes[key] = model_nbytes(model)
+                self.evict()
+        future.set_result(model)
+        return model
+
+    def evict(self):
+        """
+        Evict the least recently used models until the cache fits in the memory budget
+        :return: None
+        """
+        with self._lock:
+            while len(self._models) > 1 and self.nbytes > self.budget:
+                key, _model = self._models.popitem(last=False)
+                del self._sizes[key]
+                self.evictions += 1
+
+    def invalidate(self,
+                   directory: str = None):
+        """
+        Drop the cached models of a gauge (after it is retrained), or all of them
+        :param directory: optional, gauge directory. If not specified, the whole cache is cleared
+        :return: None
+        """
+        with self._lock:
+            for key in list(self._models):
+                if directory is None or key[0] == directory:
+                    del self._models[key]
+                    del self._sizes[key]
+            for key in list(self._loading):
+                if directory is None or key[0] == directory:
+                    del self._loading[key]
+
+    def warm_up(self,
+                entries: list):
+        """
+        Load models ahead of the first readings
+        :param entries: list of (key, loader)
+        :return: None
+        """
+        for key, loader in entries:
+            self.get(key, loader)
+
+    def stats(self) -> dict:
+        """
+        Cache counters
+        :return: dict of hits, misses, evictions, number of cached models, cached and budget sizes (bytes)
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'models': len(self._models),
+                    'nbytes': self.nbytes,
+                    'budget': self.budget}
+
+
+# Shared by all the gauges of the process
+MODEL_CACHE = ModelCache()
@@ -0,0 +1,140 @@
+import cv2
+import torch
+import numpy as np
+
+import src.utils.image_editing as ie
+from config import settings
+
+# Modes of the polar estimator: 'primary' reads with it and runs the CNN only when its estimate is not confident,
+# 'cross_check' reads with the CNN and checks it against the estimate, 'fallback' reads with the estimate only when
+# the CNN model is missing or predicts an angle outside the gauge's range
+MODES = ['off', 'primary', 'cross_check', 'fallback']
+
+
+def wrap_angle(angle: np.ndarray,
+               mid: float = 0.0) -> np.ndarray:
+    """
+    Wrap angles to the 360 degrees range centered on mid
+    :param angle: angles (degrees)
+    :param mid: center of the range (degrees)
+    :return: angles in [mid - 180, mid + 180)
+    """
+    return (np.asarray(angle) - mid + 180) % 360 - 180 + mid
+
+
+class PolarEstimator:
+    def __init__(self,
+                 base_image: np.ndarray,
+                 needle_image: np.ndarray,
+                 center: tuple,
+                 radius: float,
+                 min_angle: float,
+                 max_angle: float,
+                 bins: int = settings.POLAR_ANGLE_BINS,
+                 ring: list = settings.POLAR_RING,
+                 min_contrast: float = settings.POLAR_MIN_CONTRAST,
+                 window: float = settings.POLAR_PEAK_WINDOW):
+        """
+        Classical needle angle estimator, an alternative to GaugeNet on the same 64x64 model inputs. The input is
+        unwrapped around the gauge center with cv2.warpPolar, its difference to the unwrapped base image (without
+        the needle) is summed along the radius for each angle and the needle is at the peak of this profile.
+        The polar angle of the needle at rotation 0 is calibrated once on the composite of the base and needle images.
+        :param base_image: base image (without the needle)
+        :param needle_image: needle image (black background)
+        :param center: needle rotation center (x, y), in base image coordinates
+        :param radius: gauge radius, in base image coordinates
+        :param min_angle: needle angle of the min value (degrees)
+        :param max_angle: needle angle of the max value (degrees)
+        :param bins: number of angle bins of the polar image
+        :param ring: inner and outer radius of the summed ring, relative to the gauge radius
+        :param min_contrast: min ratio of the profile peak to the highest profile value away from it of a confident
+        estimate
+        :param window: half width (degrees) of the profile window the needle position is refined in
+        """
+        out_w, out_h = settings.TRAIN_IMAGE_SHAPE
+        h, w = base_image.shape[:2]
+        self.center = ((float(center[0]) + 0.5) * out_w / w - 0.5, (float(center[1]) + 0.5) * out_h / h - 0.5)
+        self.radius = float(radius) * min(out_w / w, out_h / h)
+        self.bins = int(bins)
+        self.radial_bins = max(int(np.ceil(self.radius)), 1)
+        self.ring = slice(int(ring[0] * self.radial_bins), max(int(np.ceil(ring[1] * self.radial_bins)), 1))
+        self.min_contrast = float(min_contrast)
+        self.mid_angle = (float(min_angle) + float(max_angle)) / 2
+        # Half width (bins) of the window the needle position is refined in
+        self.window = max(int(np.ceil(self.bins * window / 360)), 1)
+        base, needle, working_center = ie.prepare_composite(base_image, needle_image, center)
+        self.base_polar = self.unwrap(cv2.resize(np.clip(base, 0, 255).astype(np.uint8),
+                                                 (out_w, out_h),
+                                                 interpolation=cv2.INTER_AREA))[:, self.ring]
+        self.base_median = float(np.median(self.base_polar))
+        zero = ie.composite_prepared(base, needle, working_center, np.zeros(1))[0]
+        self.zero_angle = self.locate(zero)[0]
+
+    def unwrap(self,
+               image: np.ndarray) -> np.ndarray:
+        """
+        Unwrap a 64x64 image around the gauge center
+        :param image: grayscale image
+        :return: float32 polar image of shape (angle bins, radial bins), row i at i * 360 / bins degrees
+        (clockwise from the x axis, in image coordinates)
+        """
+        return cv2.warpPolar(image.astype(np.float32, copy=False),
+                             (self.radial_bins, self.bins),
+                             self.center,
+                             self.radius,
+                             cv2.INTER_LINEAR + cv2.WARP_POLAR_LINEAR)
+
+    def locate(self,
+               image: np.ndarray) -> tuple:
+        """
+        Locate the needle in the polar image of a 64x64 image
+        :param image: grayscale image (gray levels)
+        :return: polar angle of the needle (degrees) and contrast of the profile peak (ratio to the highest profile
+        value away from the peak)
+        """
+        polar = self.unwrap(image)[:, self.ring]
+        # Brightness of the ring matched to the base image (on the median, the needle covers only a few of the ring's
+        # pixels), so lighting changes do not mask the needle
+        polar = polar * (self.base_median / (np.median(polar) + 1e-6))
+        profile = np.abs(polar - self.base_polar).sum(axis=1)
+        peak = int(np.argmax(profile))
+        # Sub-bin peak position, from the centroid of the (circular) window around the peak above the profile mean
+        mean = profile.mean()
+        offsets = np.arange(-self.window, self.window + 1)
+        weights = np.maximum(profile.take(peak + offsets, mode='wrap') - mean, 0)
+        offset = float(weights @ offsets / weights.sum()) if weights.sum() > 0 else 0.0
+        # The needle must stand out from the rest of the profile (ticks, glare, occlusions) to be confident
+        others = np.delete(profile, (peak + np.arange(-2 * self.window, 2 * self.window + 1)) % self.bins)
+        contrast = float(profile[peak] / (others.max() + 1e-6)) if len(others) else 1.0
+        return ((peak + offset) * 360 / self.bins) % 360, contrast
+
+    def estimate(self,
+                 image: np.ndarray) -> tuple:
+        """
+        Estimate the needle angle of a 64x64 image
+        :param image: grayscale image (gray levels)
+        :return: needle angle (degrees, same convention as the GaugeNet labels) and contrast of the estimate
+        """
+        angle, contrast = self.locate(image)
+        return float(wrap_angle(self.zero_angle - angle, self.mid_angle)), contrast
+
+    def predict(self,
+                images: torch.Tensor) -> tuple:
+        """
+        Estimate the needle angles of a batch of model inputs
+        :param images: model inputs of shape (N, 1, H, W), normalized to [-1, 1]
+        :return: predicted angles (radians) of shape (N, 1) and boolean ndarray of the confident estimates
+        """
+        gray = (images.detach().cpu().numpy()[:, 0] + 1) * 127.5
+        angles, contrasts = zip(*[self.estimate(image) for image in gray]) if len(gray) else ((), ())
+        rad = torch.deg2rad(torch.tensor(angles, dtype=torch.float32)).reshape(-1, 1)
+        return rad, np.array(contrasts) >= self.min_contrast
+
+    def __call__(self,
+                 images: torch.Tensor) -> torch.Tensor:
+        """
+        Same interface as GaugeNet and the inference backends
+        :param images: model inputs of shape (N, 1, H, W)
+        :return: predicted angles (radians) of shape (N, 1)
+        """
+        return self.predict(images)[0]
@@ -0,0 +1,136 @@
+import os
+import copy
+import torch
+import torch.nn as nn
+import numpy as np
+
+from torch.ao import quantization as tq
+
+from config import settings
+
+# Indexes of the fused Conv2d + ReLU pairs in GaugeNet.layers
+CONV_RELU = [['0', '1'], ['3', '4'], ['6', '7']]
+# Index of the first layer of the MLP head in GaugeNet.layers (after the Flatten)
+HEAD_START = 10
+
+
+class QuantizedGaugeNet(nn.Module):
+    def __init__(self,
+                 model: nn.Module):
+        """
+        Int8 version of a GaugeNet model for CPU inference: the conv stack is statically quantized (fused Conv2d +
+        ReLU, activations calibrated on sample images) and the MLP head is dynamically quantized.
+        :param model: trained GaugeNet model
+        """
+        super(QuantizedGaugeNet, self).__init__()
+        layers = copy.deepcopy(model.layers).cpu()
+        self.quant = tq.QuantStub()
+        self.features = nn.Sequential(*layers[:HEAD_START])
+        self.dequant = tq.DeQuantStub()
+        self.head = nn.Sequential(*layers[HEAD_START:])
+
+    def forward(self, x):
+        """
+        Forward pass of the model.
+        :param x: sample of the input data (images of batch size)
+        :return: predicted angle (in radians)
+        """
+        x = self.dequant(self.features(self.quant(x)))
+        return self.head(x).type(torch.float)
+
+
+def quantize(model: nn.Module,
+             calibration_loader,
+             engine: str = settings.QUANTIZATION_ENGINE) -> QuantizedGaugeNet:
+    """
+    Post-training int8 quantization of a GaugeNet model
+    :param model: trained GaugeNet model
+    :param calibration_loader: DataLoader of (images, angles) batches used to calibrate the conv activations
+    :param engine: quantized engine ('fbgemm' for x86, 'qnnpack' for ARM)
+    :return: QuantizedGaugeNet
+    """
+    torch.backends.quantized.engine = engine
+    quantized = QuantizedGaugeNet(model).eval()
+    quantized.features = tq.fuse_modules(quantized.features, CONV_RELU)
+    quantized.qconfig = tq.get_default_qconfig(engine)
+    quantized.head.qconfig = None
+    tq.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for images, _angles in calibration_loader:
+            quantized(images.cpu())
+    tq.convert(quantized, inplace=True)
+    quantized.head = tq.quantize_dynamic(quantized.head, {nn.Linear}, dtype=torch.qint8)
+    return quantized
+
+
+def quantized_path(directory: str,
+                   version: str = settings.MODEL_VERSION,
+                   epoch: str = settings.DEFAULT_MODEL_TYPE) -> str:
+    """
+    Path of the quantized model of a gauge, next to its GaugeNet checkpoint
+    :param directory: Gauge directory
+    :param version: version of the model
+    :param epoch: epoch of the model ('best', 'last')
+    :return: path to the int8 .pt file
+    """
+    return os.path.join(directory, f'gauge_net_v{version}_{epoch}_int8.pt')
+
+
+def save(model: QuantizedGaugeNet,
+         directory: str,
+         epoch: str = settings.DEFAULT_MODEL_TYPE) -> str:
+    """
+    Saves a quantized model next to the GaugeNet checkpoint it was quantized from, as TorchScript (quantized
+    modules are not picklable)
+    :param model: QuantizedGaugeNet
+    :param directory: Gauge directory
+    :param epoch: epoch of the quantized model ('best', 'last')
+    :return: path to the int8 .pt file
+    """
+    path = quantized_path(directory, epoch=epoch)
+    torch.jit.save(torch.jit.script(model), path)
+    return path
+
+
+def load(directory: str,
+         version: str = settings.MODEL_VERSION,
+         epoch: str = settings.DEFAULT_MODEL_TYPE,
+         engine: str = settings.QUANTIZATION_ENGINE) -> QuantizedGaugeNet:
+    """
+    Loads the quantized model of a gauge
+    :param directory: Gauge directory
+    :param version: version of the model
+    :param epoch: epoch of the model ('best', 'last')
+    :param engine: quantized engine the model was quantized for
+    :return: scripted QuantizedGaugeNet, on the CPU
+    """
+    torch.backends.quantized.engine = engine
+    return torch.jit.load(quantized_path(directory, version, epoch), map_location='cpu').eval()
+
+
+def accuracy_loss(model: nn.Module,
+                  quantized: nn.Module,
+                  loader,
+                  plan) -> dict:
+    """
+    Compare a quantized model to the model it was quantized from, in gauge units
+    :param model: GaugeNet model
+    :param quantized: QuantizedGaugeNet
+    :param loader: DataLoader of (images, angles) batches
+    :param plan: ReadPlan of the gauge, maps angles to values
+    :return: dict of mean absolute errors of both models, and the mean and max difference between them
+    """
+    model = model.cpu().eval()
+    values, float_values, int8_values = [], [], []
+    with torch.no_grad():
+        for images, angles in loader:
+            images = images.cpu()
+            values.append(plan.to_values(angles))
+            float_values.append(plan.to_values(model(images)))
+            int8_values.append(plan.to_values(quantized(images)))
+    values, float_values, int8_values = [np.concatenate(x) for x in [values, float_values, int8_values]]
+    diff = np.abs(int8_values - float_values)
+    return {'fp32_mae': float(np.mean(np.abs(float_values - values))),
+            'int8_mae': float(np.mean(np.abs(int8_values - values))),
+            'mean_diff': float(np.mean(diff)),
+            'max_diff': float(np.max(diff))}
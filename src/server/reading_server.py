@@ -0,0 +1,448 @@
+import os
+import json
+import time
+import base64
+import typer
+import torch
+import asyncio
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import src.gauges.gauge as g
+import src.model.model_cache as mc
+import src.utils.ingest_queue as iq
+
+from config import settings
+
+REASONS = {200: 'OK',
+           400: 'Bad Request',
+           404: 'Not Found',
+           405: 'Method Not Allowed',
+           500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+def check_name(name,
+               root: str) -> str:
+    """
+    Check that a file name of a request stays inside its directory
+    :param name: file name, relative to root
+    :param root: directory of the files
+    :return: file name
+    """
+    if not isinstance(name, str) or not name or os.path.isabs(name):
+        raise ValueError(f'Invalid file name "{name}"')
+    root = os.path.realpath(root)
+    if os.path.commonpath([root, os.path.realpath(os.path.join(root, name))]) != root:
+        raise ValueError(f'File name "{name}" is outside of {root}')
+    return name
+
+
+class PendingRead:
+    __slots__ = ['frame', 'futures']
+
+    def __init__(self,
+                 frame: str or bytes,
+                 future: asyncio.Future):
+        """
+        A queued read request of a gauge. Requests coalesced into it get its reading too.
+        :param frame: file name in the frames directory or encoded image
+        :param future: future of the request
+        """
+        self.frame = frame
+        self.futures = [future]
+
+
+class MicroBatcher:
+    def __init__(self,
+                 gauge: g.AnalogGauge,
+                 executor: ThreadPoolExecutor,
+                 max_batch_size: int = settings.SERVER_MAX_BATCH_SIZE,
+                 max_wait: float = settings.SERVER_MAX_WAIT_MS / 1000):
+        """
+        Queue the read requests of one model and run them in batches: a batch is closed when it reaches
+        max_batch_size or when its first request has waited max_wait, then runs on the thread pool.
+        :param gauge: a gauge of the model, used to get the model from the model cache
+        :param executor: thread pool the batches run on
+        :param max_batch_size: max number of requests per batch
+        :param max_wait: max time (s) the first request of a batch waits for more requests
+        """
+        self.gauge = gauge
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self,
+                     image: torch.Tensor) -> np.ndarray:
+        """
+        Queue a preprocessed image
+        :param image: model input of shape (1, 1, H, W)
+        :return: predicted angle (radians) of the image
+        """
+        loop = asyncio.get_running_loop()
+        if self.task is None:
+            self.task = loop.create_task(self.run())
+        future = loop.create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def next_batch(self) -> list:
+        """
+        Wait for the next batch of requests
+        :return: list of (image, future)
+        """
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def predict(self,
+                images: torch.Tensor) -> np.ndarray:
+        """
+        Run a batch through the gauge's inference model (on a pool thread)
+        :param images: model input of shape (N, 1, H, W)
+        :return: predicted angles (radians) of shape (N, 1)
+        """
+        return self.gauge.predict(images).numpy()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            batch = [(image, future) for image, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            try:
+                rad = await loop.run_in_executor(self.executor,
+                                                 self.predict,
+                                                 torch.cat([image for image, _future in batch]))
+            except Exception as e:
+                for _image, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            for (_image, future), value in zip(batch, rad):
+                if not future.done():
+                    future.set_result(value)
+
+
+class ReadingServer:
+    def __init__(self,
+                 gauges: dict = None,
+                 host: str = settings.SERVER_HOST,
+                 port: int = settings.SERVER_PORT,
+                 max_batch_size: int = settings.SERVER_MAX_BATCH_SIZE,
+                 max_wait_ms: float = settings.SERVER_MAX_WAIT_MS,
+                 workers: int = settings.SERVER_WORKERS,
+                 queue_size: int = settings.INGEST_QUEUE_SIZE,
+                 policy: str = settings.INGEST_POLICY):
+        """
+        Asyncio HTTP/JSON reading service. Requests are preprocessed on a thread pool, queued per model and run in
+        micro-batches, each caller awaits its own future. Each gauge has a bounded ingest queue: under overload the
+        policy drops requests (503) or coalesces them to the latest frame, so readings stay fresh.
+        POST /read {"gauge": <XML file>, "frame": <file name in the frames directory>} or {"gauge", "image": <base64
+        encoded image>}, returns {"gauge", "reading", "units"}. GET /stats returns the service counters.
+        :param gauges: optional, dict of XML file name to AnalogGauge. Other gauges are loaded on their first request
+        :param host: host to listen on
+        :param port: port to listen on
+        :param max_batch_size: max number of requests per batch
+        :param max_wait_ms: max time (ms) the first request of a batch waits for more requests
+        :param workers: number of pool threads (preprocessing and batches)
+        :param queue_size: max number of queued requests per gauge
+        :param policy: ingest queue policy, one of 'drop_oldest', 'drop_newest', 'coalesce'
+        """
+        self.gauges = gauges if gauges is not None else {}
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batchers = {}
+        self.loading = {}
+        self.queue_size = queue_size
+        self.policy = policy
+        self.ingest = {}
+        self.drains = {}
+        self.latencies = deque(maxlen=10000)
+        self.errors = 0
+        self.server = None
+
+    async def get_gauge(self,
+                        name: str) -> g.AnalogGauge:
+        """
+        Get a gauge by its XML file name, loading it (on the pool) on its first request
+        :param name: XML file name of the gauge
+        :return: AnalogGauge
+        """
+        if name not in self.gauges:
+            if name not in self.loading:
+                # Concurrent first requests wait for the same load
+                self.loading[name] = asyncio.get_running_loop().run_in_executor(self.executor, self.load_gauge, name)
+            try:
+                self.gauges[name] = await self.loading[name]
+            finally:
+                self.loading.pop(name, None)
+        return self.gauges[name]
+
+    @staticmethod
+    def load_gauge(name: str) -> g.AnalogGauge:
+        """
+        Load a gauge for readings. Gauges are never trained by the server, a gauge without a model is not found
+        :param name: XML file name of the gauge
+        :return: AnalogGauge
+        """
+        gauge = g.AnalogGauge(name)
+        gauge.get_read_plan()
+        gauge.init_backend()
+        return gauge
+
+    def get_batcher(self,
+                    gauge: g.AnalogGauge) -> MicroBatcher:
+        """
+        Get the micro-batcher of a gauge's model, gauges sharing a model share its batcher (unless the polar needle
+        estimator is on, its estimators are per gauge)
+        :param gauge: AnalogGauge
+        :return: MicroBatcher
+        """
+        key = gauge.model_key if settings.POLAR_MODE == 'off' else gauge.directory
+        if key not in self.batchers:
+            self.batchers[key] = MicroBatcher(gauge,
+                                              self.executor,
+                                              max_batch_size=self.max_batch_size,
+                                              max_wait=self.max_wait)
+        return self.batchers[key]
+
+    async def read(self,
+                   name: str,
+                   frame: str or bytes) -> float:
+        """
+        Get a reading of a gauge, through the gauge's ingest queue
+        :param name: XML file name of the gauge
+        :param frame: file name in the frames directory or encoded image
+        :return: gauge value
+        """
+        gauge = await self.get_gauge(name)
+        if name not in self.ingest:
+            self.ingest[name] = iq.IngestQueue(maxsize=self.queue_size, policy=self.policy)
+        queue = self.ingest[name]
+        future = asyncio.get_running_loop().create_future()
+        entry = PendingRead(frame, future)
+        accepted, dropped = queue.put(entry)
+        if not accepted:
+            dropped = [entry]
+        for dropped_entry in dropped:
+            # Coalesced requests are answered with the reading of the latest frame
+            if queue.policy == 'coalesce':
+                entry.futures.extend(dropped_entry.futures)
+                continue
+            for dropped_future in dropped_entry.futures:
+                dropped_future.set_exception(iq.QueueOverloaded(f'Ingest queue of {name} is full'))
+        if name not in self.drains:
+            self.drains[name] = asyncio.get_running_loop().create_task(self.drain(name, gauge))
+        return await future
+
+    async def drain(self,
+                    name: str,
+                    gauge: g.AnalogGauge):
+        """
+        Process the queued requests of a gauge, up to max_batch_size requests at a time, until its queue is empty
+        :param name: XML file name of the gauge
+        :param gauge: AnalogGauge
+        :return: None
+        """
+        queue = self.ingest[name]
+        while True:
+            entries = []
+            while len(entries) < self.max_batch_size:
+                entry = queue.get_nowait()
+                if entry is None:
+                    break
+                entries.append(entry)
+            if not entries:
+                break
+            await asyncio.gather(*[self.process(gauge, entry) for entry in entries])
+        del self.drains[name]
+
+    async def process(self,
+                      gauge: g.AnalogGauge,
+                      entry: PendingRead):
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(self.executor, self.preprocess, gauge, entry.frame)
+            rad = await self.get_batcher(gauge).submit(image)
+            result = gauge.get_value(rad=rad)
+        except Exception as e:
+            for future in entry.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in entry.futures:
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def preprocess(gauge: g.AnalogGauge,
+                   frame: str or bytes) -> torch.Tensor:
+        """
+        Decode (if encoded) and preprocess a frame, on a pool thread
+        :param gauge: AnalogGauge
+        :param frame: file name in the frames directory or encoded image
+        :return: model input of shape (1, 1, H, W), on the CPU
+        """
+        return gauge.frame_to_image(frame).cpu()
+
+    async def handle_read(self,
+                          body: dict) -> tuple:
+        if 'gauge' not in body or ('frame' not in body and 'image' not in body):
+            return 400, {'error': 'A read request needs "gauge" and either "frame" or "image"'}
+        start = time.perf_counter()
+        try:
+            if body['gauge'] not in self.gauges:
+                check_name(body['gauge'], settings.XML_FILES_PATH)
+            # Images are decoded on the pool, after the ingest queue, so dropped requests are never decoded
+            if 'image' in body:
+                frame = base64.b64decode(body['image'], validate=True)
+            else:
+                frame = check_name(body['frame'], settings.FRAMES_PATH)
+            reading = await self.read(body['gauge'], frame)
+        except FileNotFoundError as e:
+            return 404, {'error': str(e)}
+        except (ValueError, TypeError) as e:
+            return 400, {'error': str(e)}
+        except iq.QueueOverloaded as e:
+            return 503, {'error': str(e)}
+        self.latencies.append(time.perf_counter() - start)
+        gauge = self.gauges[body['gauge']]
+        return 200, {'gauge': body['gauge'], 'reading': reading, 'units': gauge.calibration['units']}
+
+    def stats(self) -> dict:
+        """
+        Service counters: requests, batches, mean batch size, latency percentiles (ms), ingest queue and model cache
+        counters
+        :return: dict
+        """
+        requests = sum(batcher.requests for batcher in self.batchers.values())
+        batches = sum(batcher.batches for batcher in self.batchers.values())
+        latencies = np.array(self.latencies) * 1000
+        return {'requests': requests,
+                'batches': batches,
+                'mean_batch_size': requests / batches if batches else 0.0,
+                'errors': self.errors,
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+                'ingest': {name: queue.stats() for name, queue in self.ingest.items()},
+                'model_cache': mc.MODEL_CACHE.stats()}
+
+    async def route(self,
+                    method: str,
+                    path: str,
+                    body: bytes) -> tuple:
+        if path == '/read':
+            if method != 'POST':
+                return 405, {'error': 'Use POST /read'}
+            try:
+                body = json.loads(body or b'{}')
+            except json.JSONDecodeError:
+                return 400, {'error': 'The request body is not valid JSON'}
+            return await self.handle_read(body)
+        if path == '/stats':
+            return 200, self.stats()
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'Unknown path {path}'}
+
+    async def handle_connection(self,
+                                reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        """
+        Serve the HTTP/1.1 requests of a connection (keep-alive) until the client closes it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _sep, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, response = await self.route(method, path, body)
+                except Exception as e:
+                    self.errors += 1
+                    status, response = 500, {'error': str(e)}
+                payload = json.dumps(response).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        typer.secho(f'Reading server listening on http://{self.host}:{self.port}', fg='green')
+        return self.server
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            if batcher.task is not None:
+                batcher.task.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def serve(gauges: list = None,
+          host: str = settings.SERVER_HOST,
+          port: int = settings.SERVER_PORT):
+    """
+    Run the reading server until interrupted
+    :param gauges: optional, XML file names of the gauges to load at startup
+    :param host: host to listen on
+    :param port: port to listen on
+    :return: None
+    """
+    server = ReadingServer(host=host, port=port)
+    for name in gauges or []:
+        server.gauges[name] = server.load_gauge(name)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        typer.secho('Reading server stopped', fg='yellow')
@@ -0,0 +1,315 @@
+import sys
+import json
+import time
+import socket
+import asyncio
+import typer
+import torch
+import subprocess
+import dataclasses
+import numpy as np
+
+from config import settings
+
+# Modules that must not be imported by the reading path
+HEAVY_MODULES = ['tkinter', 'matplotlib', 'pandas', 'skimage', 'torchvision']
+
+
+def time_call(func,
+              *args,
+              repeat: int = settings.BENCHMARK_REPEAT,
+              **kwargs) -> float:
+    """
+    Time a function call, averaged over a number of repeats (after one warm-up call)
+    :param func: callable to time
+    :param repeat: number of timed calls
+    :return: average call time (ms)
+    """
+    func(*args, **kwargs)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args, **kwargs)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def preprocess_parity(plan,
+                      frames,
+                      tolerance: float = settings.FUSED_WARP_TOLERANCE,
+                      p99_tolerance: float = settings.FUSED_WARP_P99_TOLERANCE) -> dict:
+    """
+    Compare the fused single step preprocessing of a read plan to the staged edit steps, the reference pipeline
+    (same as ie.frame_to_read_image)
+    :param plan: ReadPlan
+    :param frames: iterable of cv2 images
+    :param tolerance: max allowed mean absolute difference (gray levels)
+    :param p99_tolerance: max allowed 99th percentile of the absolute differences (gray levels)
+    :return: dict of max, 99th percentile and mean absolute difference (gray levels) and whether both the mean and
+    the 99th percentile are within tolerance
+    """
+    fused = dataclasses.replace(plan, fused=True)
+    staged = dataclasses.replace(plan, fused=False)
+    diffs = []
+    for frame in frames:
+        # Model inputs are normalized to [-1, 1], scale back to gray levels
+        diff = (fused.to_read_image(frame) - staged.to_read_image(frame)).abs() * 127.5
+        diffs.append(diff.cpu().numpy())
+    diffs = np.concatenate(diffs)
+    report = {'max': float(diffs.max()), 'p99': float(np.percentile(diffs, 99)), 'mean': float(diffs.mean())}
+    report['passed'] = report['mean'] <= tolerance and report['p99'] <= p99_tolerance
+    return report
+
+
+def preprocess_benchmark(plan,
+                         frame: np.ndarray,
+                         repeat: int = settings.BENCHMARK_REPEAT) -> dict:
+    """
+    Benchmark the fused single step preprocessing of a read plan against the staged edit steps
+    :param plan: ReadPlan
+    :param frame: cv2 image
+    :param repeat: number of timed calls
+    :return: dict of average times (ms) and speedup
+    """
+    fused = dataclasses.replace(plan, fused=True)
+    staged = dataclasses.replace(plan, fused=False)
+    report = {'staged_ms': time_call(staged.to_read_image, frame, repeat=repeat),
+              'fused_ms': time_call(fused.to_read_image, frame, repeat=repeat)}
+    report['speedup'] = report['staged_ms'] / report['fused_ms']
+    return report
+
+
+def decode_benchmark(plan,
+                     frame: str or bytes,
+                     repeat: int = settings.BENCHMARK_REPEAT) -> dict:
+    """
+    Benchmark the reduced resolution decode and preprocessing of a frame against the full resolution one
+    :param plan: ReadPlan
+    :param frame: file name in the frames directory or encoded image
+    :param repeat: number of timed calls
+    :return: dict of reduction factor, average times (ms), speedup and mean absolute difference (gray levels)
+    between the model inputs
+    """
+    import src.utils.read_plan as rp
+    full, _factor, shape = rp.decode_frame(frame, [plan], reduced=False)
+    reduced, factor, _shape = rp.decode_frame(frame, [plan], shape)
+
+    def read(reduce: bool):
+        image, reduction, full_shape = rp.decode_frame(frame, [plan], shape, reduced=reduce)
+        return plan.to_read_image(image, factor=reduction, shape=full_shape)
+
+    report = {'factor': factor,
+              'full_ms': time_call(read, False, repeat=repeat),
+              'reduced_ms': time_call(read, True, repeat=repeat)}
+    report['speedup'] = report['full_ms'] / report['reduced_ms']
+    diff = plan.to_read_image(full) - plan.to_read_image(reduced, factor=factor, shape=shape)
+    report['mean_diff'] = float(diff.abs().mean() * 127.5)
+    return report
+
+
+def backend_benchmark(models: dict,
+                      batch_sizes: list = (1, settings.BATCH_SIZE),
+                      repeat: int = settings.BENCHMARK_REPEAT) -> dict:
+    """
+    Benchmark inference backends (or models) on random model inputs
+    :param models: dict of name to GaugeNet model or inference backend
+    :param batch_sizes: batch sizes to benchmark
+    :param repeat: number of timed calls
+    :return: dict of '<name>_b<batch size>_ms' to average call time (ms)
+    """
+    report = {}
+    for batch_size in batch_sizes:
+        images = torch.rand([batch_size, 1] + list(settings.TRAIN_IMAGE_SHAPE[::-1])).sub(0.5).div(0.5)
+        for name, model in models.items():
+            with torch.no_grad():
+                report[f'{name}_b{batch_size}_ms'] = time_call(model, images, repeat=repeat)
+    return report
+
+
+def polar_benchmark(gauge,
+                    repeat: int = settings.BENCHMARK_REPEAT) -> dict:
+    """
+    Benchmark the polar needle estimator of a gauge against its inference model on the gauge's generated test set
+    :param gauge: AnalogGauge, with a trained model
+    :param repeat: number of timed calls
+    :return: dict of mean and max absolute errors (gauge units), ratio of confident estimates and average time per
+    image (ms) of both readers
+    """
+    gauge.init_training_data(sets=['test'])
+    gauge.init_data_loaders(sets=['test'])
+    plan = gauge.get_read_plan()
+    model = gauge.inference_model
+    estimator = gauge.polar_estimator
+    values, model_values, polar_values, confident = [], [], [], []
+    with torch.inference_mode():
+        for images, angles in gauge.data_loaders['test']:
+            rad, batch_confident = estimator.predict(images)
+            values.append(plan.to_values(angles))
+            model_values.append(plan.to_values(model(images)))
+            polar_values.append(plan.to_values(rad))
+            confident.append(batch_confident)
+        image = images[:1]
+        model_ms = time_call(model, image, repeat=repeat)
+    values, model_values, polar_values, confident = [np.concatenate(x) for x in [values, model_values,
+                                                                                  polar_values, confident]]
+    model_errors = np.abs(model_values - values)
+    polar_errors = np.abs(polar_values - values)
+    return {'model_mae': float(model_errors.mean()),
+            'model_max': float(model_errors.max()),
+            'polar_mae': float(polar_errors.mean()),
+            'polar_max': float(polar_errors.max()),
+            'polar_confident': float(confident.mean()),
+            'model_ms': model_ms,
+            'polar_ms': time_call(estimator, image, repeat=repeat)}
+
+
+def engine_benchmark(gauge,
+                     frame,
+                     workers: list = (1, 2, 4),
+                     requests: int = 256) -> dict:
+    """
+    Benchmark the aggregate reading throughput of the reading engine with different numbers of worker threads
+    :param gauge: AnalogGauge
+    :param frame: cv2 image
+    :param workers: numbers of worker threads
+    :param requests: number of readings per run
+    :return: dict of readings per second per number of workers
+    """
+    import src.gauges.reading_engine as rengine
+    report = {}
+    for count in workers:
+        with rengine.ReadingEngine(workers=count) as engine:
+            engine.read_many([(gauge, frame)] * count)
+            start = time.perf_counter()
+            engine.read_many([(gauge, frame)] * requests)
+            report[f'w{count}_per_s'] = requests / (time.perf_counter() - start)
+    return report
+
+
+def import_benchmark(modules: list = ('src.gauges.gauge', 'src.gauges.camera'),
+                     repeat: int = 3,
+                     budget: float = settings.IMPORT_TIME_BUDGET) -> dict:
+    """
+    Time the cold import of the reading path, each run in a fresh interpreter, and check that none of the heavy
+    (GUI, plotting, pandas, training) modules are imported with it
+    :param modules: modules to import
+    :param repeat: number of interpreter runs, the fastest one is reported
+    :param budget: import time budget (s)
+    :return: dict of import time (s), budget, heavy modules imported and whether the import is within budget
+    """
+    code = ('import sys, time, json; start = time.perf_counter(); '
+            f'[__import__(name) for name in {list(modules)!r}]; '
+            'print(json.dumps([time.perf_counter() - start, '
+            f'[name for name in {HEAVY_MODULES!r} if name in sys.modules]]))')
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code],
+                                cwd=settings.PROJECT_ROOT,
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout
+        elapsed, heavy = json.loads(output.strip().splitlines()[-1])
+        times.append(elapsed)
+    return {'import_s': min(times),
+            'budget_s': budget,
+            'heavy_modules': ', '.join(heavy) if heavy else 'none',
+            'within_budget': min(times) <= budget and not heavy}
+
+
+async def _client(host: str,
+                  port: int,
+                  request: bytes,
+                  count: int,
+                  latencies: list,
+                  rejected: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            length = 0
+            status = (await reader.readline()).split()[1]
+            while True:
+                line = await reader.readline()
+                if line.lower().startswith(b'content-length'):
+                    length = int(line.split(b':')[1])
+                if line in (b'\r\n', b''):
+                    break
+            await reader.readexactly(length)
+            if status == b'200':
+                latencies.append(time.perf_counter() - start)
+            else:
+                rejected.append(status)
+    finally:
+        writer.close()
+
+
+def wait_for_port(host: str,
+                  port: int,
+                  timeout: float = 30.0):
+    """
+    Wait until a server accepts connections
+    :param host: server host
+    :param port: server port
+    :param timeout: max wait (s)
+    :return: None
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f'No server on {host}:{port}')
+            time.sleep(0.1)
+
+
+def server_benchmark(body: dict,
+                     host: str = settings.SERVER_HOST,
+                     port: int = settings.SERVER_PORT,
+                     concurrency: list = (1, 4, 16),
+                     requests: int = 200) -> dict:
+    """
+    Load test a running reading server with concurrent keep-alive clients
+    :param body: read request body
+    :param host: server host
+    :param port: server port
+    :param concurrency: numbers of concurrent clients
+    :param requests: number of requests per concurrency level
+    :return: dict of throughput (readings/s), p50 / p99 latency (ms) and rejected requests per concurrency level
+    """
+    payload = json.dumps(body).encode()
+    request = (f'POST /read HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+               f'Content-Length: {len(payload)}\r\n\r\n').encode() + payload
+    report = {}
+    for clients in concurrency:
+        latencies = []
+        rejected = []
+
+        async def run():
+            await asyncio.gather(*[_client(host, port, request, requests // clients, latencies, rejected)
+                                   for _ in range(clients)])
+
+        start = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        latencies = np.array(latencies) * 1000
+        report[f'c{clients}_per_s'] = len(latencies) / elapsed
+        report[f'c{clients}_p50_ms'] = float(np.percentile(latencies, 50))
+        report[f'c{clients}_p99_ms'] = float(np.percentile(latencies, 99))
+        report[f'c{clients}_rejected'] = len(rejected)
+    return report
+
+
+def print_report(title: str,
+                 report: dict):
+    """
+    Print a benchmark report
+    :param title: report title
+    :param report: dict of results
+    :return: None
+    """
+    results = ' \t|\t '.join(f'{key}: {value:0.4f}' if isinstance(value, float) else f'{key}: {value}'
+                             for key, value in report.items())
+    typer.secho(f'{title} \t|\t {results}', fg=typer.colors.CYAN)
@@ -0,0 +1,98 @@
+import threading
+import torch
+import numpy as np
+
+import torch.nn.functional as F
+
+from config import settings
+
+
+def signature(image: torch.Tensor,
+              size: int = settings.CHANGE_GATE_SIZE) -> np.ndarray:
+    """
+    Cheap signature of a model input: the image area-downsampled to size x size, in gray levels
+    :param image: model input of shape (1, 1, H, W), normalized to [-1, 1]
+    :param size: signature size (pixels)
+    :return: float32 array of shape (size, size)
+    """
+    with torch.inference_mode():
+        pooled = F.adaptive_avg_pool2d(image[:1].float(), size)
+    return (pooled[0, 0].cpu().numpy() + 1) * 127.5
+
+
+class ChangeGate:
+    def __init__(self,
+                 threshold: float = settings.CHANGE_GATE_THRESHOLD,
+                 size: int = settings.CHANGE_GATE_SIZE):
+        """
+        Per-gauge change detector on the preprocessed ROI. The signature of every inferred ROI is kept with its
+        reading, a new ROI whose signature is within the threshold of it reuses the reading instead of running the
+        model, so the inference load follows the needle motion rather than the frame rate. Signatures are compared by
+        their max absolute difference: a thin needle moving changes a few cells a lot, which a mean would dilute below
+        the sensor noise. A reading is only reused for the same key (the polar mode it was predicted with).
+        :param threshold: max absolute difference (gray levels) between the signatures of an unchanged ROI
+        :param size: signature size (pixels)
+        """
+        self.threshold = float(threshold)
+        self.size = int(size)
+        self.inferred = 0
+        self.skipped = 0
+        self._signature = None
+        self._reading = None
+        self._key = None
+        self._lock = threading.Lock()
+
+    def lookup(self,
+               image: torch.Tensor,
+               key=None) -> tuple:
+        """
+        Compare a model input to the last inferred one
+        :param image: model input of shape (1, 1, H, W)
+        :param key: optional, key the reading must have been stored with
+        :return: signature of the image and the cached reading, or None if the ROI or the key changed
+        """
+        current = signature(image, self.size)
+        with self._lock:
+            if (self._signature is not None and self._key == key
+                    and np.max(np.abs(current - self._signature)) <= self.threshold):
+                self.skipped += 1
+                return current, self._reading
+        return current, None
+
+    def store(self,
+              current: np.ndarray,
+              reading: float,
+              key=None):
+        """
+        Keep the signature of an inferred model input with its reading
+        :param current: signature returned by lookup
+        :param reading: gauge value
+        :param key: optional, key of the reading
+        :return: None
+        """
+        with self._lock:
+            self._signature = current
+            self._reading = reading
+            self._key = key
+            self.inferred += 1
+
+    def reset(self):
+        """
+        Forget the last inferred ROI (after the model or the calibration changed)
+        :return: None
+        """
+        with self._lock:
+            self._signature = None
+            self._reading = None
+            self._key = None
+
+    def stats(self) -> dict:
+        """
+        Gate counters
+        :return: dict of threshold, inferred and skipped readings and skip ratio
+        """
+        total = self.inferred + self.skipped
+        return {'threshold': self.threshold,
+                'inferred': self.inferred,
+                'skipped': self.skipped,
+                'skip_ratio': self.skipped / total if total else 0.0}
@@ -0,0 +1,270 @@
+import os
+import time
+import threading
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import shared_memory
+
+import src.utils.read_plan as rp
+from config import settings
+
+# Worker side state, set once per worker process by the pool initializers
+_worker = {}
+
+
+class RingBuffer:
+    def __init__(self,
+                 slots: int,
+                 shape: tuple,
+                 dtype=np.uint8,
+                 name: str = None):
+        """
+        Fixed number of same-shape slots in one shared memory block. Processes pass slots by index, each process
+        maps the block once and reads or writes the slots in place.
+        :param slots: number of slots
+        :param shape: shape of a slot
+        :param dtype: slot type
+        :param name: optional, name of an existing block to attach. If not specified, a new block is created
+        """
+        self.slots = int(slots)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(self.slots * int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.array = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self) -> tuple:
+        """
+        Arguments used by other processes to attach the ring buffer
+        """
+        return self.slots, self.shape, self.dtype.str, self.shm.name
+
+    @classmethod
+    def attach(cls, spec: tuple):
+        slots, shape, dtype, name = spec
+        return cls(slots, shape, dtype, name=name)
+
+    def __getitem__(self, slot: int) -> np.ndarray:
+        return self.array[slot]
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SlotPool:
+    def __init__(self,
+                 slots: int):
+        """
+        Ownership of the slots of the ring buffers, kept by the coordinating process. A slot is acquired for a frame
+        and explicitly released once the frame's readings are done, only then can it be reused.
+        :param slots: number of slots
+        """
+        self.slots = slots
+        self.free = list(range(slots))[::-1]
+        self.acquired = 0
+        self.waits = 0
+        self.max_in_use = 0
+        self._available = threading.Condition()
+
+    @property
+    def in_use(self) -> int:
+        return self.slots - len(self.free)
+
+    def acquire(self,
+                timeout: float = None) -> int:
+        """
+        Acquire a free slot, waiting for one if all the slots are in use
+        :param timeout: optional, max wait (s)
+        :return: slot index
+        """
+        with self._available:
+            if not self.free:
+                self.waits += 1
+                if not self._available.wait_for(lambda: len(self.free) > 0, timeout=timeout):
+                    raise TimeoutError('No free frame bus slot')
+            slot = self.free.pop()
+            self.acquired += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            return slot
+
+    def release(self,
+                slot: int):
+        with self._available:
+            if slot in self.free:
+                raise ValueError(f'Slot {slot} is already free')
+            self.free.append(slot)
+            self._available.notify()
+
+
+def _attach_decoder(spec: tuple,
+                    plans: list):
+    """
+    Decode pool initializer: attach the image ring buffer and keep the gauges' read plans
+    """
+    _worker['images'] = RingBuffer.attach(spec)
+    _worker['plans'] = plans
+
+
+def _decode_slot(slot: int,
+                 frame: str or bytes) -> int:
+    """
+    Decode a frame and preprocess every gauge's 64x64 input into its image slot. Frames are decoded and
+    preprocessed like AnalogGauge.get_reading does, at the reduced resolution picked from the previous frame of the
+    worker. The decoded frame stays private to the worker, only the inputs go through shared memory
+    :param slot: slot index
+    :param frame: file name in the frames directory, image path or encoded image
+    :return: slot index
+    """
+    plans = _worker['plans']
+    decoded, factor, shape = rp.decode_frame(frame, plans, _worker.get('shape'))
+    _worker['shape'] = shape
+    images = _worker['images']
+    for index, plan in enumerate(plans):
+        images[slot][index] = plan.to_read_image(decoded, factor=factor, shape=shape)[0].numpy()
+    return slot
+
+
+def _attach_inference(spec: tuple,
+                      gauges: list):
+    """
+    Inference pool initializer: attach the image ring buffer and load the gauges' models
+    """
+    import src.gauges.gauge as g
+    _worker['images'] = RingBuffer.attach(spec)
+    _worker['gauges'] = [g.AnalogGauge(calibration, backend=backend) for calibration, backend in gauges]
+
+
+def _infer_slot(slot: int,
+                polar_mode: str) -> list:
+    """
+    Run the gauges' models on their inputs in an image slot, read in place. Gauges are grouped like
+    CameraReader.get_readings does, every distinct model runs a single forward pass
+    :param slot: slot index
+    :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
+    :return: list of predicted angles (radians), one per gauge
+    """
+    import torch
+    import src.gauges.camera as camera
+    images = torch.from_numpy(_worker['images'][slot])
+    gauges = _worker['gauges']
+    rad = camera.predict_rows(gauges, images, list(range(len(gauges))), polar_mode)
+    return [rad[index] for index in range(len(gauges))]
+
+
+class FrameBus:
+    def __init__(self,
+                 gauges: list,
+                 slots: int = settings.FRAME_BUS_SLOTS,
+                 decode_workers: int = settings.FRAME_BUS_DECODE_WORKERS,
+                 inference_workers: int = settings.FRAME_BUS_INFERENCE_WORKERS,
+                 polar_mode: str = settings.POLAR_MODE):
+        """
+        Two-stage reading pipeline over shared memory: a process pool decodes frames and preprocesses the gauges'
+        inputs, another process pool runs the models. The 64x64 inputs stay in a shared ring buffer and move between
+        the stages by slot index, only the frames, the slot index and the readings are pickled.
+        :param gauges: list of AnalogGauge objects read from every frame
+        :param slots: number of frames in flight
+        :param decode_workers: number of decode processes (0 for all the cores but one)
+        :param inference_workers: number of inference processes
+        :param polar_mode: Polar needle estimator mode, one of 'off', 'primary', 'cross_check', 'fallback'
+        """
+        self.gauges = gauges
+        self.polar_mode = polar_mode
+        out_w, out_h = settings.TRAIN_IMAGE_SHAPE
+        self.images = RingBuffer(slots, (len(gauges), 1, out_h, out_w), np.float32)
+        self.pool = SlotPool(slots)
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=10000)
+        decode_workers = int(decode_workers) or max(1, (os.cpu_count() or 1) - 1)
+        self.decoder = ProcessPoolExecutor(max_workers=decode_workers,
+                                           initializer=_attach_decoder,
+                                           initargs=(self.images.spec, [gauge.get_read_plan() for gauge in gauges]))
+        self.inference = ProcessPoolExecutor(max_workers=int(inference_workers),
+                                             initializer=_attach_inference,
+                                             initargs=(self.images.spec,
+                                                       [(gauge.calibration, gauge.backend_name) for gauge in gauges]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self,
+               frame: str or bytes,
+               timeout: float = None) -> Future:
+        """
+        Read the gauges from a frame. Waits for a free slot if all the slots are in flight
+        :param frame: file name in the frames directory, image path or encoded image
+        :param timeout: optional, max wait (s) for a free slot
+        :return: future of the dict of gauge index to reading
+        """
+        slot = self.pool.acquire(timeout=timeout)
+        result = Future()
+        start = time.perf_counter()
+
+        def done(future: Future):
+            try:
+                rad = future.result()
+                readings = {gauge.calibration['index']: float(gauge.get_values(rad=[value])[0])
+                            for gauge, value in zip(self.gauges, rad)}
+            except Exception as e:
+                self.failed += 1
+                self.pool.release(slot)
+                result.set_exception(e)
+                return
+            self.pool.release(slot)
+            self.completed += 1
+            self.latencies.append(time.perf_counter() - start)
+            result.set_result(readings)
+
+        def decoded(future: Future):
+            try:
+                future.result()
+            except Exception as e:
+                self.failed += 1
+                self.pool.release(slot)
+                result.set_exception(e)
+                return
+            self.inference.submit(_infer_slot, slot, self.polar_mode).add_done_callback(done)
+
+        self.decoder.submit(_decode_slot, slot, frame).add_done_callback(decoded)
+        return result
+
+    def read_many(self,
+                  frames: list) -> list:
+        """
+        Read the gauges from a list of frames through the pipeline
+        :param frames: list of frames
+        :return: list of dicts of gauge index to reading, in the frames order
+        """
+        futures = [self.submit(frame) for frame in frames]
+        return [future.result() for future in futures]
+
+    def stats(self) -> dict:
+        """
+        Occupancy counters of the frame bus
+        :return: dict of slots, slots in use, max slots in use, acquired slots, waits for a free slot, completed
+        and failed frames and mean latency (ms)
+        """
+        return {'slots': self.pool.slots,
+                'in_use': self.pool.in_use,
+                'max_in_use': self.pool.max_in_use,
+                'acquired': self.pool.acquired,
+                'waits': self.pool.waits,
+                'completed': self.completed,
+                'failed': self.failed,
+                'mean_ms': float(np.mean(self.latencies) * 1000) if self.latencies else 0.0}
+
+    def close(self):
+        self.decoder.shutdown(wait=True)
+        self.inference.shutdown(wait=True)
+        self.images.close()
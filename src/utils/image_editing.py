@@ -1,10 +1,10 @@
 import cv2
 import os
 from dataclasses import dataclass, asdict
+from pathlib import Path
 import numpy as np
+import torch
 import PIL.Image as Image
-import PIL.ImageTk as ImageTk
-import torchvision.transforms as tf
 
 from config import settings
 import src.utils.point_math as pm
@@ -28,7 +28,93 @@ def factor_resize(image: np.ndarray):
     return image, h, w
 
 
+# Bytes per pixel of the row layout of the raw pixel formats. NV12 rows hold the Y plane (the interleaved UV plane
+# follows it), YUYV rows hold Y0 U Y1 V macropixels
+PIXEL_FORMATS = {'GRAY8': 1, 'BGR24': 3, 'NV12': 1, 'YUYV': 2}
+
+
+@dataclass(frozen=True)
+class RawFrame:
+    """
+    Raw frame buffer from a capture process (bytes, bytearray, memoryview, mmap or shared memory buffer).
+    The frame is read as a NumPy view of the buffer, the pixels are never copied.
+    """
+    buffer: object
+    width: int
+    height: int
+    pixel_format: str = 'GRAY8'  # one of PIXEL_FORMATS
+    stride: int = None  # bytes per row, width * bytes per pixel if not specified
+    offset: int = 0  # offset of the first row in the buffer (bytes)
+
+    def view(self) -> np.ndarray:
+        """
+        Wrap the buffer as a cv2 image without copying it: GRAY8 and NV12 frames as their (h, w) grayscale plane,
+        BGR24 frames as (h, w, 3) images and YUYV frames as the (h, w) view of their Y samples (every other byte)
+        :return: read-only (for immutable buffers) ndarray view of the buffer
+        """
+        if self.pixel_format not in PIXEL_FORMATS:
+            raise ValueError(f'Unknown pixel format "{self.pixel_format}", must be one of {", ".join(PIXEL_FORMATS)}')
+        bpp = PIXEL_FORMATS[self.pixel_format]
+        stride = self.stride or self.width * bpp
+        if stride < self.width * bpp:
+            raise ValueError(f'Stride {stride} is smaller than a {self.width} pixels {self.pixel_format} row')
+        size = memoryview(self.buffer).nbytes
+        if self.offset + stride * (self.height - 1) + self.width * bpp > size:
+            raise ValueError(f'Buffer of {size} bytes is too small for a {self.width}x{self.height} '
+                             f'{self.pixel_format} frame')
+        if self.pixel_format == 'BGR24':
+            return np.ndarray((self.height, self.width, 3), dtype=np.uint8, buffer=self.buffer,
+                              offset=self.offset, strides=(stride, 3, 1))
+        return np.ndarray((self.height, self.width), dtype=np.uint8, buffer=self.buffer,
+                          offset=self.offset, strides=(stride, bpp))
+
+
+def load_frame(frame: str or bytes or RawFrame or np.ndarray,
+               flags: int = cv2.IMREAD_GRAYSCALE) -> np.ndarray:
+    """
+    Load a frame from the frames directory, decode an encoded frame or wrap a raw frame buffer, images are
+    returned as is
+    :param frame: file name in the frames directory, encoded image (bytes, bytearray or memoryview), RawFrame
+    or image
+    :param flags: cv2.imread and cv2.imdecode flags
+    :return: cv2 image
+    """
+    if isinstance(frame, str):
+        path = (Path(settings.FRAMES_PATH) / frame).as_posix()
+        frame = cv2.imread(path, flags)
+        if frame is None:
+            raise FileNotFoundError(f'Image not found: {path}')
+    elif isinstance(frame, (bytes, bytearray, memoryview)):
+        frame = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), flags)
+        if frame is None:
+            raise ValueError('The image could not be decoded')
+    elif isinstance(frame, RawFrame):
+        frame = frame.view()
+    return frame
+
+
+def is_jpeg(frame: str or bytes or RawFrame or np.ndarray) -> bool:
+    """
+    Check if a frame file or an encoded frame is a JPEG image, from its SOI marker. Only JPEG images have
+    reduced resolution decodes that are not decoded at full resolution first
+    :param frame: file name in the frames directory, encoded image (bytes, bytearray or memoryview), RawFrame
+    or image
+    :return: bool
+    """
+    if isinstance(frame, str):
+        try:
+            with open(Path(settings.FRAMES_PATH) / frame, 'rb') as file:
+                return file.read(2) == b'\xff\xd8'
+        except OSError:
+            return False
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return bytes(frame[:2]) == b'\xff\xd8'
+    return False
+
+
 def cv_to_imagetk(image):
+    # ImageTk imports tkinter, only needed by the calibrator
+    import PIL.ImageTk as ImageTk
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     image = Image.fromarray(image)
     image = ImageTk.PhotoImage(image)
@@ -64,6 +150,91 @@ def rotate_needle(train_image: np.ndarray,
     return blended, rotated_needle
 
 
+def prepare_composite(train_image: np.ndarray,
+                      needle_image: np.ndarray,
+                      needle_center: tuple,
+                      shape: list = settings.TRAIN_IMAGE_SHAPE,
+                      supersample: int = settings.COMPOSITE_SUPERSAMPLE) -> tuple:
+    """
+    Prepare the inputs of composite_prepared: the base image, needle and needle mask are converted to grayscale
+    and downsampled once to a supersampled working resolution.
+    :param train_image: base image (without the needle)
+    :param needle_image: needle image (black background)
+    :param needle_center: needle rotation center (x, y), in base image coordinates
+    :param shape: output (width, height)
+    :param supersample: working resolution factor relative to the output shape
+    :return: float32 base image (H, W), float32 needle and mask (H, W, 2), needle center at working resolution
+    """
+    h, w = train_image.shape[:2]
+    scale = min(supersample * max(shape) / max(h, w), 1.0)
+    size = (max(int(round(w * scale)), 1), max(int(round(h * scale)), 1))
+    if len(train_image.shape) > 2:
+        train_image = cv2.cvtColor(train_image, cv2.COLOR_BGR2GRAY)
+    if len(needle_image.shape) > 2:
+        needle_image = cv2.cvtColor(needle_image, cv2.COLOR_BGR2GRAY)
+    mask = cv2.threshold(needle_image, 10, 255, cv2.THRESH_BINARY)[1]
+    base = cv2.resize(train_image, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    needle = cv2.merge([cv2.resize(needle_image, size, interpolation=cv2.INTER_AREA),
+                        cv2.resize(mask, size, interpolation=cv2.INTER_AREA)]).astype(np.float32)
+    center = tuple((float(c) + 0.5) * scale - 0.5 for c in needle_center)
+    return base, needle, center
+
+
+def composite_prepared(base: np.ndarray,
+                       needle: np.ndarray,
+                       center: tuple,
+                       needle_angles: np.ndarray,
+                       shape: list = settings.TRAIN_IMAGE_SHAPE,
+                       out: np.ndarray = None) -> np.ndarray:
+    """
+    Rotate the prepared needle and its mask with cv2.warpAffine for each angle, blend them on the base image
+    a chunk of angles at a time and resize (area interpolation) to the output shape.
+    :param base: prepared base image
+    :param needle: prepared needle and mask
+    :param center: prepared needle center
+    :param needle_angles: array of N needle angles (degrees)
+    :param shape: output (width, height)
+    :param out: optional, uint8 array of shape (N, height, width) to write the images to
+    :return: uint8 array of N grayscale images of shape (N, height, width)
+    """
+    size = (base.shape[1], base.shape[0])
+    images = np.empty((len(needle_angles), shape[1], shape[0]), dtype=np.uint8) if out is None else out
+    chunk_size = 256  # bounds the float working buffers for large angle arrays
+    for start in range(0, len(needle_angles), chunk_size):
+        angles = needle_angles[start:start + chunk_size]
+        rotated = np.empty((len(angles), size[1], size[0], 2), dtype=np.float32)
+        for index, angle in enumerate(angles):
+            matrix = cv2.getRotationMatrix2D(center, float(angle), 1.0)
+            rotated[index] = cv2.warpAffine(needle, matrix, size, flags=cv2.INTER_LINEAR)
+        alpha = rotated[..., 1] / 255
+        # The needle was downsampled on a black background, its edge pixels are already weighted by their coverage
+        blended = base * (1 - alpha) + rotated[..., 0]
+        blended = np.clip(blended, 0, 255).astype(np.uint8)
+        for index, image in enumerate(blended, start=start):
+            images[index] = cv2.resize(image, tuple(shape), interpolation=cv2.INTER_AREA)
+    return images
+
+
+def composite_needles(train_image: np.ndarray,
+                      needle_image: np.ndarray,
+                      needle_center: tuple,
+                      needle_angles: np.ndarray,
+                      shape: list = settings.TRAIN_IMAGE_SHAPE,
+                      supersample: int = settings.COMPOSITE_SUPERSAMPLE) -> np.ndarray:
+    """
+    Batch version of rotate_needle for synthetic data, see prepare_composite and composite_prepared.
+    :param train_image: base image (without the needle)
+    :param needle_image: needle image (black background)
+    :param needle_center: needle rotation center (x, y), in base image coordinates
+    :param needle_angles: array of N needle angles (degrees)
+    :param shape: output (width, height)
+    :param supersample: working resolution factor relative to the output shape
+    :return: uint8 array of N grayscale images of shape (N, height, width)
+    """
+    base, needle, center = prepare_composite(train_image, needle_image, needle_center, shape, supersample)
+    return composite_prepared(base, needle, center, needle_angles, shape)
+
+
 def create_circle(obj,
                   x,
                   y,
@@ -125,18 +296,58 @@ def frame_to_read_image(frame,
     if len(frame.shape) > 2:
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
     frame = cv2.resize(frame, settings.TRAIN_IMAGE_SHAPE)
-    frame = Image.fromarray(frame)
-    transform = tf.Compose([tf.ToTensor(), tf.Normalize(mean=[0.5], std=[0.5])])
-    frame = transform(frame)
+    frame = process_image(frame)
     return frame.unsqueeze(0).to(settings.DEVICE)
 
 
 scale = list(np.linspace(0.81, 0.99, 10))
 
-process_image = tf.Compose([tf.ToTensor(),
-                            tf.Normalize(mean=[0.5], std=[0.5])])
 
-image_augmentor = tf.Compose([tf.RandomApply([tf.ColorJitter(0.1, 0.1, 0.1, 0.1)], p=0.5)])
+def process_image(image) -> torch.Tensor:
+    """
+    Convert an image to the model's input, same as tf.Compose([tf.ToTensor(), tf.Normalize(mean=[0.5], std=[0.5])])
+    without importing torchvision on the reading path
+    :param image: grayscale or color image (ndarray or PIL image)
+    :return: normalized image tensor of shape (C, H, W)
+    """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = image[:, :, None]
+    max_value = 255 if image.dtype == np.uint8 else 1
+    image = image.transpose(2, 0, 1).astype(np.float32, order='C')
+    return torch.from_numpy(image).div_(max_value).sub_(0.5).div_(0.5)
+
+
+def __getattr__(name):
+    # torchvision is only imported when the training augmentor is used
+    if name == 'image_augmentor':
+        import torchvision.transforms as tf
+        return tf.Compose([tf.RandomApply([tf.ColorJitter(0.1, 0.1, 0.1, 0.1)], p=0.5)])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def augment_batch(images: torch.Tensor,
+                  brightness: float = settings.AUGMENT_BRIGHTNESS,
+                  contrast: float = settings.AUGMENT_CONTRAST,
+                  noise: float = settings.AUGMENT_NOISE,
+                  generator: torch.Generator = None) -> torch.Tensor:
+    """
+    Random brightness, contrast and gaussian noise augmentation of a batch of images, as batched tensor ops
+    :param images: float tensor of shape (N, C, H, W) in [0, 1]
+    :param brightness: max relative brightness change
+    :param contrast: max relative contrast change
+    :param noise: standard deviation of the gaussian noise
+    :param generator: optional, torch random generator
+    :return: augmented float tensor of shape (N, C, H, W) in [0, 1]
+    """
+    n = images.shape[0]
+    factors = 1 + (torch.rand(n, 1, 1, 1, generator=generator) * 2 - 1) * brightness
+    images = images * factors
+    factors = 1 + (torch.rand(n, 1, 1, 1, generator=generator) * 2 - 1) * contrast
+    mean = images.mean(dim=(1, 2, 3), keepdim=True)
+    images = (images - mean) * factors + mean
+    images = images + torch.randn(images.shape, generator=generator) * noise
+    return images.clamp_(0, 1)
 
 
 @dataclass
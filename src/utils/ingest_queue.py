@@ -0,0 +1,102 @@
+import threading
+
+from collections import deque
+
+from config import settings
+
+POLICIES = ['drop_oldest', 'drop_newest', 'coalesce']
+
+
+class QueueOverloaded(Exception):
+    """
+    Raised for the requests a bounded ingest queue dropped
+    """
+    pass
+
+
+class IngestQueue:
+    def __init__(self,
+                 maxsize: int = settings.INGEST_QUEUE_SIZE,
+                 policy: str = settings.INGEST_POLICY):
+        """
+        Bounded, thread-safe ingest queue of frames (or read requests). When the queue is full a new item is handled
+        by the policy, so a burst never grows the queue (and the latency) without limit:
+        'drop_oldest' drops the oldest queued item, 'drop_newest' drops the new item, 'coalesce' replaces every queued
+        item with the new one, keeping only the latest.
+        :param maxsize: max number of queued items
+        :param policy: one of 'drop_oldest', 'drop_newest', 'coalesce'
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown ingest policy "{policy}", must be one of {", ".join(POLICIES)}')
+        self.maxsize = max(1, int(maxsize))
+        self.policy = policy
+        self.received = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._items = deque()
+        self._not_empty = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def put(self,
+            item) -> tuple:
+        """
+        Queue an item, never blocks
+        :param item: frame or request
+        :return: True if the new item was queued (False if the policy dropped it) and list of the queued items the
+        policy dropped in its place
+        """
+        with self._not_empty:
+            self.received += 1
+            dropped = []
+            if len(self._items) >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False, dropped
+                if self.policy == 'coalesce':
+                    dropped = list(self._items)
+                    self._items.clear()
+                else:
+                    dropped = [self._items.popleft()]
+            self._items.append(item)
+            self.dropped += len(dropped)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._not_empty.notify()
+            return True, dropped
+
+    def get(self,
+            timeout: float = None):
+        """
+        Take the oldest queued item, waiting for one
+        :param timeout: optional, max wait (s). If not specified, waits until an item is queued
+        :return: item, or None on timeout
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: len(self._items) > 0, timeout=timeout):
+                return None
+            return self._items.popleft()
+
+    def get_nowait(self):
+        """
+        Take the oldest queued item without waiting
+        :return: item, or None if the queue is empty
+        """
+        with self._not_empty:
+            return self._items.popleft() if self._items else None
+
+    def stats(self) -> dict:
+        """
+        Queue counters
+        :return: dict of policy, max size, current and max depth, received and dropped items
+        """
+        return {'policy': self.policy,
+                'maxsize': self.maxsize,
+                'depth': len(self._items),
+                'max_depth': self.max_depth,
+                'received': self.received,
+                'dropped': self.dropped}
@@ -0,0 +1,401 @@
+import cv2
+import functools
+import math
+import threading
+import numpy as np
+import torch
+
+from dataclasses import dataclass, field
+
+from config import settings
+import src.utils.image_editing as ie
+
+
+# Per-thread preprocessing buffers, reused by every reading of the thread
+_buffers = threading.local()
+# cv2.imread and cv2.imdecode flags of the reduced resolution decodes, by reduction factor
+REDUCED_FLAGS = {1: cv2.IMREAD_GRAYSCALE,
+                 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def thread_buffer(name: str,
+                  shape: tuple,
+                  dtype=np.uint8) -> np.ndarray:
+    """
+    Get a preprocessing buffer of the calling thread, reallocated only when the shape or type changes
+    :param name: buffer name
+    :param shape: buffer shape
+    :param dtype: buffer type
+    :return: ndarray, only valid until the thread's next call with the same name
+    """
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, buffer)
+    return buffer
+
+
+def parse_points(points) -> tuple:
+    """
+    Parse perspective points as saved in the calibration (lists, tuples or '[x, y]' strings from the XML file)
+    :param points: four perspective points
+    :return: tuple of four (x, y) int tuples
+    """
+    parsed = []
+    for pts in points:
+        if isinstance(pts, str):
+            pts = pts.strip('[').strip(']').split(',')
+        parsed.append(tuple(int(float(x)) for x in pts))
+    return tuple(parsed)
+
+
+def perspective_matrix(w: int,
+                       h: int,
+                       pts) -> np.ndarray:
+    """
+    Get the 3x3 perspective matrix used by ie.four_point_transform for a (w, h) window
+    :param w: window width
+    :param h: window height
+    :param pts: points that define the transformation
+    :return: read-only 3x3 matrix
+    """
+    source = np.float32([[0, 0],
+                         [w, 0],
+                         [w, h],
+                         [0, h]])
+    dest = np.float32(pts)
+    matrix = cv2.getPerspectiveTransform(dest, source)
+    matrix.flags.writeable = False
+    return matrix
+
+
+def window_shape(crop: tuple) -> tuple:
+    """
+    Get the window (w, h) of a cropped frame after it is resized by ie.factor_resize
+    :param crop: crop coordinates (y, y_diff, x, x_diff)
+    :return: (w, h)
+    """
+    y, y_diff, x, x_diff = crop
+    h, w = y_diff - y, x_diff - x
+    factor = max(h, w)
+    return int(w * settings.WINDOW_SIZE[0] / factor), int(h * settings.WINDOW_SIZE[1] / factor)
+
+
+def resize_matrix(sx: float,
+                  sy: float) -> np.ndarray:
+    """
+    Get the 3x3 matrix of a cv2.resize by (sx, sy), in pixel index coordinates
+    :param sx: x scale
+    :param sy: y scale
+    :return: 3x3 matrix
+    """
+    return np.array([[sx, 0, 0.5 * sx - 0.5],
+                     [0, sy, 0.5 * sy - 0.5],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def reduced_shape(h: int,
+                  w: int,
+                  factor: int) -> tuple:
+    """
+    Get the shape of a (h, w) frame decoded at a reduced resolution
+    :param h: full resolution frame height
+    :param w: full resolution frame width
+    :param factor: reduction factor
+    :return: (h, w)
+    """
+    return -(-h // factor), -(-w // factor)
+
+
+def decode_frame(frame,
+                 plans: list,
+                 shape: tuple = None,
+                 reduced: bool = settings.REDUCED_DECODE == 'True') -> tuple:
+    """
+    Load a frame, decoding a JPEG frame file or encoded frame at the largest reduced resolution that still leaves
+    enough pixels for every read plan. The reduction factor is picked from the full resolution shape of the
+    previous frame of the same source, the first frame (or a frame whose size changed) is decoded at full resolution.
+    Other formats are decoded at full resolution: their reduced decodes are resized from a full decode, which is
+    slower and does not round the shape like JPEG does.
+    :param frame: file name in the frames directory, encoded image, RawFrame or image
+    :param plans: read plans of the gauges read from the frame
+    :param shape: optional, full resolution (h, w) of the previous frame. If not specified, decodes at full resolution
+    :param reduced: Decode at a reduced resolution when possible
+    :return: cv2 image, reduction factor and full resolution (h, w) of the frame
+    """
+    factor = 1
+    if reduced and shape is not None and plans and ie.is_jpeg(frame):
+        factor = min(plan.decode_factor(*shape) for plan in plans)
+    image = ie.load_frame(frame, flags=REDUCED_FLAGS[factor])
+    if factor > 1:
+        if image.shape[:2] == reduced_shape(*shape, factor):
+            return image, factor, tuple(shape)
+        image = ie.load_frame(frame)
+    return image, 1, image.shape[:2]
+
+
+@functools.lru_cache(maxsize=256)
+def fused_matrix(plan,
+                 h: int,
+                 w: int,
+                 reduction: int = 1) -> np.ndarray:
+    """
+    Fold the resize, crop, resize, perspective and final resize steps of a read plan into one matrix,
+    mapping a raw (h, w) frame straight to the model's input
+    :param plan: ReadPlan
+    :param h: raw frame height
+    :param w: raw frame width
+    :param reduction: reduction factor of the decoded frame, its pixels are first mapped to the full resolution ones
+    :return: read-only 3x3 matrix
+    """
+    factor = max(h, w)
+    w1, h1 = int(w * settings.WINDOW_SIZE[0] / factor), int(h * settings.WINDOW_SIZE[1] / factor)
+    matrix = resize_matrix(w1 / w, h1 / h)
+    if plan.crop is not None:
+        y, y_diff, x, x_diff = plan.crop
+        y, y_diff, x, x_diff = min(y, h1), min(y_diff, h1), min(x, w1), min(x_diff, w1)
+        matrix = np.array([[1, 0, -x], [0, 1, -y], [0, 0, 1]], dtype=np.float64) @ matrix
+        h1, w1 = y_diff - y, x_diff - x
+    factor = max(h1, w1)
+    w2, h2 = int(w1 * settings.WINDOW_SIZE[0] / factor), int(h1 * settings.WINDOW_SIZE[1] / factor)
+    matrix = resize_matrix(w2 / w1, h2 / h1) @ matrix
+    if plan.perspective is not None:
+        matrix = plan.window_matrix(w2, h2) @ matrix
+    out_w, out_h = settings.TRAIN_IMAGE_SHAPE
+    matrix = resize_matrix(out_w / w2, out_h / h2) @ matrix
+    if reduction > 1:
+        matrix = matrix @ resize_matrix(reduction, reduction)
+    matrix.flags.writeable = False
+    return matrix
+
+
+@functools.lru_cache(maxsize=64)
+def area_taps(size: int,
+              window: int) -> tuple:
+    """
+    Get the taps of a cv2.INTER_AREA resize along one axis. Downsampling, window pixel i averages the frame pixels
+    under [i * size / window, (i + 1) * size / window), weighted by their overlap. Upsampling, it interpolates the
+    frame pixel under it and the next one, only across the frame pixel boundaries (nearly a nearest neighbor resize)
+    :param size: frame size along the axis
+    :param window: resized size along the axis
+    :return: int array of frame pixel indices and float array of weights, both of shape (window, taps)
+    """
+    scale = size / window
+    if scale > 1:
+        start = np.arange(window) * scale
+        index = np.floor(start).astype(int)[:, None] + np.arange(int(math.ceil(scale)) + 1)
+        weight = np.clip(np.minimum(index + 1, start[:, None] + scale) - np.maximum(index, start[:, None]), 0, None)
+        return np.minimum(index, size - 1), weight / scale
+    first = np.floor(np.arange(window) * scale).astype(int)
+    fraction = np.arange(1, window + 1) - (first + 1) / scale
+    fraction = np.where(fraction <= 0, 0, fraction - np.floor(fraction))
+    return np.minimum(first[:, None] + np.arange(2), size - 1), np.stack([1 - fraction, fraction], axis=1)
+
+
+@functools.lru_cache(maxsize=64)
+def fused_taps(plan,
+               h: int,
+               w: int,
+               reduction: int,
+               frame_h: int,
+               frame_w: int) -> tuple:
+    """
+    Fold the steps of a read plan into per-pixel taps of the raw frame. The staged edit steps first resize the whole
+    frame to the window size with cv2.INTER_AREA (ie.factor_resize), averaging the pixels of frames larger than the
+    window, and only interpolate after, so a single bilinear warp of the raw frame would skip the averaging. Instead,
+    each pixel of the model's input is the bilinear interpolation of the 2x2 window pixels around its position, each
+    resized from the frame pixels under it: only these frame pixels are read. Both steps are separable, the taps are
+    kept per axis.
+    :param plan: ReadPlan
+    :param h: full resolution frame height
+    :param w: full resolution frame width
+    :param reduction: reduction factor the frame was decoded at
+    :param frame_h: decoded frame height
+    :param frame_w: decoded frame width
+    :return: read-only (rows, row weights, columns, column weights) arrays of shape (H * W, taps)
+    """
+    window_w, window_h = window_shape((0, h, 0, w))
+    # Window pixel coordinates of the model input's pixels
+    matrix = fused_matrix(plan, h, w, reduction) @ np.linalg.inv(resize_matrix(window_w / frame_w,
+                                                                              window_h / frame_h))
+    out_w, out_h = settings.TRAIN_IMAGE_SHAPE
+    grid = np.stack(np.meshgrid(np.arange(out_w), np.arange(out_h)), axis=-1).reshape(1, -1, 2)
+    points = cv2.perspectiveTransform(grid.astype(np.float64), np.linalg.inv(matrix))[0]
+    taps = []
+    for axis, (size, window) in enumerate([(frame_w, window_w), (frame_h, window_h)]):
+        first = np.floor(points[:, axis]).astype(int)
+        fraction = points[:, axis] - first
+        # Bilinear neighbors, outside of the window they are black (as cv2.warpPerspective's border)
+        neighbors = first[:, None] + np.arange(2)
+        bilinear = np.stack([1 - fraction, fraction], axis=1) * ((neighbors >= 0) & (neighbors < window))
+        neighbors = np.clip(neighbors, 0, window - 1)
+        index, weight = area_taps(size, window)
+        index = index[neighbors].reshape(len(points), -1)
+        weight = (bilinear[:, :, None] * weight[neighbors]).reshape(len(points), -1)
+        taps += [index.astype(np.intp), weight.astype(np.float32)]
+    for array in taps:
+        array.flags.writeable = False
+    columns, column_weights, rows, row_weights = taps
+    return rows, row_weights, columns, column_weights
+
+
+@dataclass(frozen=True)
+class ReadPlan:
+    """
+    Pre-compiled edit steps and value mapping of a calibrated gauge. Built once from the calibration
+    and reused for every reading, so the calibration dictionary is not parsed per frame.
+    """
+    crop: tuple = None  # (y, y_diff, x, x_diff), None if no crop is restored
+    perspective: tuple = None  # four (x, y) points, None if no perspective transform is restored
+    min_angle: float = 0.0
+    step_value: float = 1.0
+    min_value: float = 0.0
+    fused: bool = True  # use the single step fast path instead of the staged edit steps
+    window: tuple = field(default=None, init=False)  # (w, h) of the window the perspective is applied to
+    matrix: np.ndarray = field(default=None, init=False, compare=False, repr=False)
+    transform: object = field(default=ie.process_image, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.crop is not None and self.perspective is not None:
+            window = window_shape(self.crop)
+            object.__setattr__(self, 'window', window)
+            object.__setattr__(self, 'matrix', perspective_matrix(*window, self.perspective))
+
+    @classmethod
+    def from_calibration(cls,
+                         calibration: dict,
+                         restore_edit_steps: bool = True):
+        """
+        Compile the read plan of a gauge from its calibration
+        :param calibration: calibration dictionary (from the XML file or the calibrator)
+        :param restore_edit_steps: Restore the crop and perspective edit steps as saved in the XML file
+        :return: ReadPlan
+        """
+        crop = None
+        perspective = None
+        if restore_edit_steps:
+            crop = tuple(int(x) for x in calibration['crop'])
+            if str(calibration['perspective_changed']) == 'True':
+                perspective = parse_points(calibration['perspective'])
+        return cls(crop=crop,
+                   perspective=perspective,
+                   fused=settings.FUSED_WARP == 'True',
+                   min_angle=float(calibration['needle']['min_angle']),
+                   step_value=float(calibration['step_value']),
+                   min_value=float(calibration['min_value']))
+
+    def window_matrix(self,
+                      w: int,
+                      h: int) -> np.ndarray:
+        """
+        Get the perspective matrix for a window, the compiled one is reused when the window matches
+        :param w: window width
+        :param h: window height
+        :return: 3x3 perspective matrix
+        """
+        if (w, h) == self.window:
+            return self.matrix
+        return perspective_matrix(w, h, self.perspective)
+
+    def decode_factor(self,
+                      h: int,
+                      w: int,
+                      oversample: float = settings.REDUCED_DECODE_OVERSAMPLE) -> int:
+        """
+        Get the largest reduced decode factor that leaves enough pixels in the crop of a (h, w) frame
+        :param h: full resolution frame height
+        :param w: full resolution frame width
+        :param oversample: min number of crop pixels per model input pixel, along each axis
+        :return: 8, 4, 2, or 1 for a full resolution decode
+        """
+        crop_w, crop_h = w, h
+        if self.crop is not None:
+            y, y_diff, x, x_diff = self.crop
+            scale = max(h, w)
+            crop_w = (x_diff - x) * scale / settings.WINDOW_SIZE[0]
+            crop_h = (y_diff - y) * scale / settings.WINDOW_SIZE[1]
+        out_w, out_h = settings.TRAIN_IMAGE_SHAPE
+        for factor in sorted(REDUCED_FLAGS, reverse=True):
+            if crop_w / factor >= out_w * oversample and crop_h / factor >= out_h * oversample:
+                return factor
+        return 1
+
+    def to_read_image(self,
+                      frame: np.ndarray,
+                      factor: int = 1,
+                      shape: tuple = None) -> torch.Tensor:
+        """
+        Apply the edit steps to a frame and convert it to the model's input
+        :param frame: cv2 image
+        :param factor: reduction factor the frame was decoded at
+        :param shape: full resolution (h, w) of a reduced frame
+        :return: image tensor of shape (1, 1, H, W)
+        """
+        if self.fused:
+            return self.fused_read_image(frame, factor=factor, shape=shape)
+        # The staged steps resize the frame to the window size first, whatever its resolution
+        return self.staged_read_image(frame)
+
+    def fused_read_image(self,
+                         frame: np.ndarray,
+                         factor: int = 1,
+                         shape: tuple = None) -> torch.Tensor:
+        """
+        Sample a raw frame straight into the model's input in one step, into the thread's buffers. Each input pixel
+        is read from the few frame pixels the staged edit steps would interpolate it from (see fused_taps)
+        :param frame: cv2 image
+        :param factor: reduction factor the frame was decoded at
+        :param shape: full resolution (h, w) of a reduced frame
+        :return: image tensor of shape (1, 1, H, W)
+        """
+        h, w = shape if factor > 1 else frame.shape[:2]
+        out_w, out_h = settings.TRAIN_IMAGE_SHAPE
+        rows, row_weights, columns, column_weights = fused_taps(self, h, w, factor, *frame.shape[:2])
+        values = np.einsum('na,nab...,nb->n...',
+                           row_weights,
+                           frame[rows[:, :, None], columns[:, None, :]],
+                           column_weights,
+                           dtype=np.float32)
+        frame = thread_buffer('fused', (out_h, out_w) + frame.shape[2:], frame.dtype)
+        np.rint(values.reshape(frame.shape), out=frame, casting='unsafe')
+        if len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=thread_buffer('gray', (out_h, out_w), frame.dtype))
+        frame = self.transform(frame)
+        return frame.unsqueeze(0).to(settings.DEVICE)
+
+    def staged_read_image(self,
+                          frame: np.ndarray) -> torch.Tensor:
+        """
+        Apply the edit steps one after the other, same as ie.frame_to_read_image
+        :param frame: cv2 image
+        :return: image tensor of shape (1, 1, H, W)
+        """
+        frame, _x, _y = ie.factor_resize(frame)
+        if self.crop is not None:
+            y, y_diff, x, x_diff = self.crop
+            frame = frame[y:y_diff, x:x_diff]
+        frame, _x, _y = ie.factor_resize(frame)
+        if self.perspective is not None:
+            h, w = frame.shape[:2]
+            frame = cv2.warpPerspective(frame, self.window_matrix(w, h), (w, h))
+        if len(frame.shape) > 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        frame = cv2.resize(frame, settings.TRAIN_IMAGE_SHAPE)
+        frame = self.transform(frame)
+        return frame.unsqueeze(0).to(settings.DEVICE)
+
+    def to_values(self,
+                  rad: torch.Tensor or np.ndarray) -> np.ndarray:
+        """
+        Converts a batch of angles (radians) to values
+        :param rad: model output of shape (N, 1) or (N,)
+        :return: ndarray of values of shape (N,)
+        """
+        if isinstance(rad, torch.Tensor):
+            rad = rad.detach().cpu().numpy()
+        angle = np.rad2deg(np.asarray(rad, dtype=np.float64).reshape(-1))
+        # min_angle - angle for positive angles, min_angle + |angle| for negative ones
+        min_rel_angle = self.min_angle - angle
+        return self.min_value + min_rel_angle * self.step_value